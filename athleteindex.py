@@ -0,0 +1,86 @@
+# Where every athlete placed on every segment, built once from the crawled
+# leaderboards. The segment tracker and individual rankings used to crawl every
+# leaderboard for each athlete and scan the rankings for their name, so a club
+# of 200 meant 200 crawls. With the index the leaderboards are crawled once and
+# any number of athletes are looked up from it.
+
+import os
+import re
+from collections import namedtuple
+
+import leaderboard
+
+# rank uses the same tie rules as the leaderboard points, athletes with the same
+# time share the rank of the first of them and the next one skips ahead.
+AthleteResult = namedtuple('AthleteResult', 'segment, seconds, rank, field_size')
+
+def tie_aware_ranks(rankings):
+    # Yields the rank of each (athlete, seconds) in rankings, sorted by seconds.
+    prev_time = None
+    rank = 0
+    for (count, (name, time)) in enumerate(rankings, 1):
+        if time != prev_time:
+            rank = count
+        prev_time = time
+        yield rank
+
+class AthleteIndex():
+    def __init__(self, segments):
+        self.segments = list(dict.fromkeys(segments))
+        self.results = {}
+
+    def add(self, segment, rankings):
+        for (rank, (name, seconds)) in zip(tie_aware_ranks(rankings), rankings):
+            self.results.setdefault(name, []).append(AthleteResult(segment, seconds, rank, len(rankings)))
+
+    def get(self, name):
+        # The athlete's results in the order the segments were added.
+        return self.results.get(name, [])
+
+    def missing_segments(self, name):
+        done = set(result.segment for result in self.get(name))
+        return [segment for segment in self.segments if segment not in done]
+
+    def __contains__(self, name):
+        return name in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+class AthleteIndexGatherer(leaderboard.SegmentRankingsGatherer):
+    def __init__(self, segment, config, run_config, index):
+        super().__init__(segment, config, run_config)
+        self.index = index
+
+    def process_rankings(self, rankings):
+        self.index.add(self.segment, rankings)
+
+def build_index(snapshot, config, run_config):
+    # Crawls every segment in config for the options of run_config, all of them
+    # concurrently, and indexes the combined rankings.
+    index = AthleteIndex(config.segments)
+    leaderboard.run_gatherers([AthleteIndexGatherer(segment, config, run_config, index)
+                               for segment in index.segments], snapshot)
+    return index
+
+def read_names(filename):
+    # One athlete name per line, as it shows on the leaderboard.
+    with open(filename, "r") as file:
+        return list(dict.fromkeys(line.strip() for line in file if line.strip() != ""))
+
+def output_files(output_dir, names):
+    # A map of name -> the CSV file to write for them in output_dir. Anything
+    # but letters, digits, dots and dashes becomes an underscore, and names that
+    # end up the same get a number added.
+    files = {}
+    used = set()
+    for name in names:
+        base = re.sub(r'[^\w.-]+', '_', name).strip('_') or "athlete"
+        filename = base
+        suffix = 2
+        while filename.lower() in used:
+            filename = "{}_{}".format(base, suffix)
+            suffix = suffix + 1
+        used.add(filename.lower())
+        files[name] = os.path.join(output_dir, filename + ".csv")
+    return files
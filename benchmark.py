@@ -0,0 +1,209 @@
+#!/usr/bin/env python3.8
+
+# Offline benchmarks for the hot paths of the leaderboard and route builder
+# tools, run across growing input sizes. Nothing touches the network: leaderboard
+# pages are recorded from the fake Strava fetcher once and then replayed through
+# the real crawler, distances come from the haversine based fake Google Maps
+# client, and routes are built from the segments in segment_information/.
+#
+# Results can be saved as a JSON baseline and later runs compared against it.
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import fakes
+import heldkarp
+import leaderboard
+import routeplanner
+from distancematrix import DistanceMatrixBuilder
+from segmentstore import InvalidSegmentError, parse_segment_json
+
+class ReplayFetcher():
+    # Serves pages recorded from another fetcher, keyed by url.
+    def __init__(self, pages):
+        self.pages = pages
+
+    def fetch(self, url):
+        return self.pages[url]
+
+class RecordingFetcher():
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+        self.pages = {}
+
+    def fetch(self, url):
+        self.pages[url] = self.fetcher.fetch(url)
+        return self.pages[url]
+
+def load_fixture_segments(directory):
+    # The segments in segment_information/ that have a polyline, as lists of latlngs.
+    segments = []
+    for filename in sorted(os.listdir(directory)):
+        (segment_id, extension) = os.path.splitext(filename)
+        if extension != ".json": continue
+        with open(os.path.join(directory, filename), "r") as file:
+            try:
+                segment = parse_segment_json(segment_id, json.loads(file.read()))
+            except (InvalidSegmentError, ValueError):
+                continue
+        segments.append({"length": segment.length, "latlngs": segment.latlngs()})
+    return segments
+
+def route_points(segments, size):
+    # The fixture segments joined end to end, repeated until there are size points.
+    points = []
+    while len(points) < size:
+        for segment in segments:
+            points.extend(segment["latlngs"])
+    return points[:size]
+
+def best_time(function, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run_quietly(function):
+    # The crawler and route builder print progress, which would swamp the results.
+    def quiet():
+        stdout = sys.stdout
+        with open(os.devnull, "w") as devnull:
+            sys.stdout = devnull
+            try:
+                function()
+            finally:
+                sys.stdout = stdout
+    return quiet
+
+def benchmark_leaderboard(size, fixtures, repeat):
+    # Crawls and parses ten leaderboards of size riders each.
+    options = ["filter=overall"]
+    leaderboards = {}
+    for segment in range(10):
+        rows = [("Rider {}".format(i), 60 + (i * 7 + segment) % (4 * 3600)) for i in range(size)]
+        leaderboards[str(segment)] = {options[0]: sorted(rows, key=lambda a : a[1])}
+    keys = [(segment, option) for segment in leaderboards for option in options]
+
+    recorder = RecordingFetcher(fakes.FakeLeaderboardFetcher(leaderboards))
+    run_quietly(lambda: leaderboard.LeaderboardSnapshot(
+        leaderboard.SegmentCrawler(None, fetcher=recorder, max_workers=1)).fetch(keys))()
+    replay = ReplayFetcher(recorder.pages)
+    return best_time(run_quietly(lambda: leaderboard.LeaderboardSnapshot(
+        leaderboard.SegmentCrawler(None, fetcher=replay, max_workers=1)).fetch(keys)), repeat)
+
+def benchmark_heldkarp(size, fixtures, repeat):
+    builder = DistanceMatrixBuilder(fakes.FakeMapsClient())
+    start_latlng = fixtures[0]["latlngs"][0]
+    dists = []
+    run_quietly(lambda: dists.extend(routeplanner.get_segment_distances(builder, start_latlng, fixtures[:size - 1])))()
+    return best_time(lambda: heldkarp.held_karp(dists), repeat)
+
+def benchmark_heldkarp_best_8(size, fixtures, repeat):
+    # Picking the best 8 of size segments.
+    builder = DistanceMatrixBuilder(fakes.FakeMapsClient())
+    start_latlng = fixtures[0]["latlngs"][0]
+    dists = []
+    run_quietly(lambda: dists.extend(routeplanner.get_segment_distances(builder, start_latlng, fixtures[:size])))()
+    return best_time(lambda: heldkarp.held_karp_best_k(dists, 8), repeat)
+
+def benchmark_greedy(size, fixtures, repeat):
+    # Includes the distance matrix lookups against the fake client.
+    builder = DistanceMatrixBuilder(fakes.FakeMapsClient())
+    start_latlng = fixtures[0]["latlngs"][0]
+    segment_latlngs = [x["latlngs"] for x in fixtures[:size]]
+    return best_time(lambda: routeplanner.get_segment_ordering_greedy(
+        builder, start_latlng, segment_latlngs, -1, []), repeat)
+
+def benchmark_distance(size, fixtures, repeat):
+    points = route_points(fixtures, size)
+    return best_time(lambda: routeplanner.compute_distance_in_miles(points), repeat)
+
+def benchmark_write_gpx(size, fixtures, repeat):
+    points = route_points(fixtures, size)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "route.gpx")
+        return best_time(lambda: routeplanner.write_gpx(points, filename), repeat)
+
+# name -> (function, sizes, what the size counts)
+BENCHMARKS = {
+    "leaderboard": (benchmark_leaderboard, [100, 1000, 10000], "riders"),
+    "heldkarp": (benchmark_heldkarp, [8, 12, 15], "segments"),
+    "heldkarp_best_8": (benchmark_heldkarp_best_8, [12, 18, 25], "segments"),
+    "greedy": (benchmark_greedy, [10, 40, 80], "segments"),
+    "distance_in_miles": (benchmark_distance, [1000, 10000, 100000], "points"),
+    "write_gpx": (benchmark_write_gpx, [1000, 10000, 100000], "points"),
+}
+
+def compare(results, baseline, tolerance):
+    # Prints how each result moved against the baseline and returns the names
+    # of the ones that got slower by more than tolerance.
+    regressions = []
+    print("benchmark,baseline_seconds,seconds,change")
+    for (name, seconds) in results.items():
+        if name not in baseline:
+            print("{},,{:.6f},".format(name, seconds))
+            continue
+        change = seconds / max(baseline[name], 1e-9) - 1
+        print("{},{:.6f},{:.6f},{:+.1%}".format(name, baseline[name], seconds, change))
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the leaderboard and route builder hot paths without the network"
+    )
+
+    parser.add_argument("--benchmarks", type=str, required=False, default=",".join(BENCHMARKS),
+                        help="The csv list of benchmarks to run")
+    parser.add_argument("--segment_directory", type=str, required=False,
+                        default=routeplanner.SEGMENT_JSON_DIRECTORY,
+                        help="The directory of segment JSON files to build routes from")
+    parser.add_argument("--repeat", type=int, required=False, default=3,
+                        help="The number of times to run each benchmark, the fastest is kept")
+    parser.add_argument("--output_file", type=str, required=False, default=None,
+                        help="If set, the results are saved here as a JSON baseline")
+    parser.add_argument("--baseline_file", type=str, required=False, default=None,
+                        help="If set, the results are compared against this baseline")
+    parser.add_argument("--tolerance", type=float, required=False, default=0.25,
+                        help=("""How much slower than the baseline a benchmark can get, as a fraction,
+                                 before it counts as a regression and the exit status is non zero"""))
+    args = parser.parse_args()
+
+    fixtures = load_fixture_segments(args.segment_directory)
+    results = {}
+    print("benchmark,size,unit,seconds")
+    for name in args.benchmarks.split(","):
+        (function, sizes, unit) = BENCHMARKS[name]
+        for size in sizes:
+            seconds = function(size, fixtures, args.repeat)
+            results["{}/{}".format(name, size)] = seconds
+            print("{},{},{},{:.6f}".format(name, size, unit, seconds))
+
+    if args.output_file is not None:
+        with open(args.output_file, "w") as file:
+            file.write(json.dumps({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results,
+            }, indent=2))
+
+    if args.baseline_file is not None:
+        with open(args.baseline_file, "r") as file:
+            baseline = json.loads(file.read())["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print("Slower than the baseline: " + ",".join(regressions))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
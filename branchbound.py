@@ -0,0 +1,243 @@
+# Exact segment ordering for more segments than Held-Karp can hold in memory.
+# A depth first branch and bound grows the tour one segment at a time from the
+# start. The bound for a partial tour is the assignment problem over the
+# distance matrix with the tour's edges fixed and the edge that would close it
+# early forbidden. Every tour is an assignment, so no tour through that partial
+# tour can be shorter.
+#
+# The assignment is solved with the Hungarian algorithm, and a child reuses its
+# parent's assignment and dual potentials. Fixing one more edge only breaks a
+# couple of assigned pairs, and each one is repaired with a single O(n^2)
+# augmenting path instead of solving from scratch. The search starts with the
+# nearest neighbor tour improved by the local search optimizer as the best tour
+# so far. If the node or time limit stops it early, the smallest bound left
+# unexplored tells how far from optimal the returned tour can be.
+#
+# The assignment bound is weak when distances are close to symmetric, which
+# they usually are between nearby segments. So the reported lower bound is also
+# checked against a Held-Karp 1-tree bound on the cheaper direction of every
+# edge. It is too slow to compute at every node, but once at the root it often
+# narrows the reported gap a lot.
+
+import time
+
+import numpy as np
+
+import metrics
+import optimizer
+
+# Stands in for a forbidden edge. Finite so that potentials stay finite.
+FORBIDDEN = 1e12
+
+class Assignment():
+    # An optimal assignment of rows to columns of cost along with the dual
+    # potentials that prove it.
+    def __init__(self, cost, u, v, row_of_column):
+        self.cost = cost
+        self.u = u
+        self.v = v
+        self.row_of_column = row_of_column
+
+    @classmethod
+    def solve(cls, cost):
+        n = len(cost)
+        assignment = cls(cost.copy(), np.zeros(n), np.zeros(n), np.full(n, -1, dtype=np.int64))
+        for row in range(n):
+            assignment._augment(row)
+        return assignment
+
+    def copy(self):
+        return Assignment(self.cost.copy(), self.u.copy(), self.v.copy(), self.row_of_column.copy())
+
+    def value(self):
+        return float(np.sum(self.cost[self.row_of_column, np.arange(len(self.cost))]))
+
+    def _augment(self, row):
+        # Assigns a free row by the shortest augmenting path in reduced costs,
+        # adjusting the potentials as it goes.
+        cost = self.cost
+        n = len(cost)
+        self.u[row] = np.min(cost[row] - self.v)
+        minimum = np.full(n, np.inf)
+        way = np.full(n, -1, dtype=np.int64)
+        used = np.zeros(n, dtype=bool)
+        (current_row, current_column) = (row, -1)
+        while True:
+            reduced = cost[current_row] - self.u[current_row] - self.v
+            better = ~used & (reduced < minimum)
+            minimum[better] = reduced[better]
+            way[better] = current_column
+            masked = np.where(used, np.inf, minimum)
+            next_column = int(np.argmin(masked))
+            delta = masked[next_column]
+
+            used_columns = np.flatnonzero(used)
+            self.u[row] = self.u[row] + delta
+            self.u[self.row_of_column[used_columns]] += delta
+            self.v[used_columns] -= delta
+            minimum[~used] -= delta
+            used[next_column] = True
+
+            current_column = next_column
+            if self.row_of_column[current_column] == -1: break
+            current_row = self.row_of_column[current_column]
+
+        while True:
+            previous_column = way[current_column]
+            if previous_column == -1:
+                self.row_of_column[current_column] = row
+                break
+            self.row_of_column[current_column] = self.row_of_column[previous_column]
+            current_column = previous_column
+
+    def forbid(self, edges):
+        # Makes each (row, column) edge forbidden and repairs the assignment.
+        free_rows = []
+        for (row, column) in edges:
+            self.cost[row, column] = FORBIDDEN
+            if self.row_of_column[column] == row:
+                self.row_of_column[column] = -1
+                free_rows.append(row)
+        for row in free_rows:
+            self._augment(row)
+
+def one_tree_bound(dists, upper_bound, iterations=100):
+    # The Held-Karp lower bound: minimum 1-trees (a spanning tree of nodes 1..n-1
+    # plus the two cheapest edges at 0) with node penalties found by subgradient
+    # ascent, using the cheaper direction of each edge. Every tour is a 1-tree
+    # whatever the penalties are, so each 1-tree found is a lower bound.
+    dists = np.asarray(dists, dtype=np.float64)
+    n = len(dists)
+    if n < 3:
+        return 0.0
+    weights = np.minimum(dists, dists.T)
+    penalties = np.zeros(n)
+    best = -np.inf
+    scale = 2.0
+    since_improved = 0
+    for i in range(iterations):
+        cost = weights + penalties[:, None] + penalties[None, :]
+        np.fill_diagonal(cost, np.inf)
+
+        # Prim's algorithm over nodes 1..n-1.
+        degree = np.zeros(n, dtype=np.int64)
+        in_tree = np.zeros(n, dtype=bool)
+        in_tree[0] = True
+        in_tree[1] = True
+        closest = cost[1].copy()
+        parent = np.ones(n, dtype=np.int64)
+        total = 0.0
+        for j in range(n - 2):
+            candidates = np.where(in_tree, np.inf, closest)
+            node = int(np.argmin(candidates))
+            total = total + candidates[node]
+            degree[node] += 1
+            degree[parent[node]] += 1
+            in_tree[node] = True
+            closer = ~in_tree & (cost[node] < closest)
+            closest[closer] = cost[node][closer]
+            parent[closer] = node
+        ends = np.argsort(cost[0, 1:], kind="stable")[:2] + 1
+        total = total + cost[0, ends[0]] + cost[0, ends[1]]
+        degree[0] = 2
+        degree[ends] += 1
+
+        value = total - 2 * np.sum(penalties)
+        if value > best + 1e-9:
+            (best, since_improved) = (value, 0)
+        else:
+            since_improved = since_improved + 1
+            if since_improved >= 10:
+                (scale, since_improved) = (scale / 2, 0)
+        subgradient = degree - 2
+        norm = np.sum(subgradient * subgradient)
+        if norm == 0 or value >= upper_bound:
+            # The 1-tree is a tour, or the bound can't get any better.
+            break
+        penalties = penalties + scale * (upper_bound - value) / norm * subgradient
+    return float(best)
+
+class BranchAndBound():
+    def __init__(self, dists, max_nodes=None, time_limit_seconds=None):
+        self.dists = np.asarray(dists, dtype=np.float64)
+        self.n = len(dists)
+        self.max_nodes = max_nodes
+        self.time_limit_seconds = time_limit_seconds
+        self.nodes = 0
+
+    def _child(self, parent, path, next_node, visited):
+        # The assignment for path extended by next_node: the edge from the end of
+        # path to next_node is fixed by forbidding every other edge out of it and
+        # into next_node, and next_node can't go back to the start unless it is
+        # the last one.
+        last = path[len(path) - 1]
+        child = parent.copy()
+        edges = [(last, j) for j in range(self.n) if j != next_node and child.cost[last, j] < FORBIDDEN]
+        edges = edges + [(i, next_node) for i in range(self.n) if i != last and child.cost[i, next_node] < FORBIDDEN]
+        if len(visited) + 1 < self.n:
+            edges.append((next_node, 0))
+        child.forbid(edges)
+        return child
+
+    def solve(self, incumbent_path):
+        # Returns (path, cost, lower bound). The path is optimal when its cost
+        # equals the lower bound.
+        start = time.monotonic()
+        best_path = list(incumbent_path)
+        best_cost = optimizer.tour_cost(self.dists, best_path)
+        if self.n <= 2:
+            # There is only one tour.
+            return (best_path, best_cost, best_cost)
+
+        cost = self.dists.copy()
+        np.fill_diagonal(cost, FORBIDDEN)
+        root = Assignment.solve(cost)
+
+        # Entries are (bound, path, parent assignment, next node). Children are
+        # only worked out when they are popped, so just one assignment per level
+        # of the tree is kept alive.
+        stack = [(root.value(), [0], root, None)]
+        stopped = False
+        while len(stack) > 0:
+            (bound, path, assignment, next_node) = stack.pop()
+            if bound >= best_cost - 1e-9: continue
+            if (self.max_nodes is not None and self.nodes >= self.max_nodes) or \
+               (self.time_limit_seconds is not None and time.monotonic() - start > self.time_limit_seconds):
+                stack.append((bound, path, assignment, next_node))
+                stopped = True
+                break
+
+            self.nodes = self.nodes + 1
+            if next_node is not None:
+                assignment = self._child(assignment, path, next_node, set(path))
+                path = path + [next_node]
+                bound = assignment.value()
+                if bound >= best_cost - 1e-9: continue
+
+            if len(path) == self.n:
+                # Everything is fixed, so the assignment is this tour.
+                (best_path, best_cost) = (path, bound)
+                continue
+
+            # Children are visited cheapest reduced cost first, so they go on the
+            # stack in the opposite order.
+            last = path[len(path) - 1]
+            visited = set(path)
+            candidates = [j for j in range(self.n) if j not in visited]
+            reduced = [assignment.cost[last, j] - assignment.u[last] - assignment.v[j] for j in candidates]
+            for j in [candidates[i] for i in np.argsort(reduced, kind="stable")[::-1]]:
+                # A child's bound is at least its parent's.
+                stack.append((bound, path, assignment, j))
+
+        metrics.count("branch_and_bound_nodes", self.nodes)
+        lower_bound = best_cost
+        if stopped:
+            lower_bound = min([best_cost] + [bound for (bound, _, _, _) in stack])
+            lower_bound = min(max(lower_bound, one_tree_bound(self.dists, best_cost)), best_cost)
+        return (best_path, best_cost, lower_bound)
+
+def solve(dists, max_nodes=None, time_limit_seconds=None, seed_seconds=1):
+    # The nearest neighbor tour improved by local search for seed_seconds is
+    # where the search starts. Returns (path, cost, lower bound).
+    seed = optimizer.optimize_tour(dists, seed_seconds)
+    return BranchAndBound(dists, max_nodes, time_limit_seconds).solve(seed)
@@ -0,0 +1,176 @@
+# Divide and conquer segment ordering for very large segment lists. Segments are
+# clustered by location with k-means, splitting any cluster that is still too
+# big for Held-Karp. The order to visit the clusters in is solved on their
+# centroids, then every cluster is solved exactly on its own, in parallel on a
+# process pool, and the tours are joined in cluster order.
+#
+# Each cluster is solved as an open path with a dummy node standing in for
+# everything outside it. The edge from the dummy into a segment costs the
+# straight line distance from the previous cluster, and the edge from a segment
+# to the dummy the straight line distance to the next one, so the path enters
+# and leaves the cluster on the sides facing its neighbors. Once joined, the
+# segments on either side of each cluster boundary are solved again exactly
+# using road distances. Only distances within a cluster or a boundary window are
+# looked up, so the number of distance matrix elements grows with the number of
+# segments rather than its square.
+
+import math
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from haversine import Unit
+
+import heldkarp
+import optimizer
+from geometry import EARTH_RADIUS_KM, haversine_distances
+
+def project(lats, lngs):
+    # Kilometers east and north of the points' mean, close enough for clustering.
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    km_per_degree = EARTH_RADIUS_KM * math.pi / 180
+    x = (lngs - np.mean(lngs)) * km_per_degree * math.cos(math.radians(np.mean(lats)))
+    y = (lats - np.mean(lats)) * km_per_degree
+    return np.column_stack((x, y))
+
+def kmeans(points, k, seed=1, iterations=50):
+    # Lloyd's algorithm with k-means++ seeding. Returns a cluster label per point.
+    rng = np.random.default_rng(seed)
+    centers = [points[rng.integers(len(points))]]
+    for i in range(1, k):
+        squared = np.min([np.sum((points - c) ** 2, axis=1) for c in centers], axis=0)
+        if np.sum(squared) == 0: break
+        centers.append(points[rng.choice(len(points), p=squared / np.sum(squared))])
+    centers = np.array(centers)
+
+    labels = np.zeros(len(points), dtype=np.int64)
+    for i in range(iterations):
+        squared = np.sum((points[:, None, :] - centers[None, :, :]) ** 2, axis=2)
+        new_labels = np.argmin(squared, axis=1)
+        if i > 0 and np.array_equal(new_labels, labels): break
+        labels = new_labels
+        for c in range(len(centers)):
+            if np.any(labels == c):
+                centers[c] = np.mean(points[labels == c], axis=0)
+    return labels
+
+def split_clusters(points, max_cluster_size, seed=1):
+    # Returns a list of arrays of point indices, none longer than max_cluster_size.
+    pending = [np.arange(len(points))]
+    k = max(1, math.ceil(len(points) / max_cluster_size))
+    clusters = []
+    while len(pending) > 0:
+        members = pending.pop()
+        if len(members) <= max_cluster_size:
+            clusters.append(members)
+            continue
+        labels = kmeans(points[members], min(k, len(members)), seed)
+        groups = [members[labels == c] for c in np.unique(labels)]
+        if len(groups) == 1:
+            # Points on top of each other, there's nothing to split them on.
+            groups = [members[i:i + max_cluster_size] for i in range(0, len(members), max_cluster_size)]
+        pending.extend(groups)
+        k = 2
+    return clusters
+
+def order_clusters(start_latlng, centroids, time_budget_seconds):
+    # The order to visit the clusters in, from straight line distances between
+    # the start and their centroids. Returns cluster indices.
+    lats = np.array([float(start_latlng["lat"])] + [c[0] for c in centroids])
+    lngs = np.array([float(start_latlng["lng"])] + [c[1] for c in centroids])
+    dists = haversine_distances(lats[:, None], lngs[:, None], lats[None, :], lngs[None, :], Unit.METERS)
+    if len(dists) <= 13:
+        path = heldkarp.held_karp(dists)
+    else:
+        path = optimizer.optimize_tour(dists, time_budget_seconds)
+    return [i - 1 for i in path if i != 0]
+
+def solve_cluster(dists):
+    # An open path through a cluster, from its distance matrix with the dummy
+    # node at 0. Runs in a worker process.
+    if len(dists) <= 2:
+        return list(range(len(dists)))
+    return heldkarp.held_karp(dists)
+
+def cluster_distances(matrix, lengths, entry_distances, exit_distances):
+    # The matrix Held-Karp solves for one cluster. matrix[i][j] is the road
+    # distance from the end of segment i to the start of segment j.
+    n = len(lengths) + 1
+    dists = [[0] * n for i in range(n)]
+    for j in range(1, n):
+        dists[0][j] = entry_distances[j - 1] + lengths[j - 1]
+        dists[j][0] = exit_distances[j - 1]
+        for i in range(1, n):
+            if i == j: continue
+            dists[i][j] = matrix[i - 1][j - 1] + lengths[j - 1]
+    return dists
+
+def improve_boundary(matrix_builder, start_latlng, segment_information, order, first, last):
+    # Reorders order[first:last] in place to the best path between the segment
+    # before it and the one after it, or the start point at either end.
+    window = order[first:last]
+    before = segment_information[order[first - 1]]["latlngs"] if first > 0 else [start_latlng]
+    after = segment_information[order[last]]["latlngs"] if last < len(order) else [start_latlng]
+    starts = [segment_information[i]["latlngs"][0] for i in window]
+    ends = [segment_information[i]["latlngs"][len(segment_information[i]["latlngs"]) - 1] for i in window]
+
+    # Row 0 is the end of the segment before, column len(window) the start of the one after.
+    matrix = matrix_builder.build([before[len(before) - 1]] + ends, starts + [after[0]])
+    lengths = [segment_information[i]["length"] for i in window]
+    inner = [row[:len(window)] for row in matrix[1:]]
+    entries = matrix[0][:len(window)]
+    exits = [row[len(window)] for row in matrix[1:]]
+    path = heldkarp.held_karp(cluster_distances(inner, lengths, entries, exits))
+    order[first:last] = [window[i - 1] for i in path if i != 0]
+
+def order_segments(matrix_builder, start_latlng, segment_information, max_cluster_size=10,
+                   max_workers=None, time_budget_seconds=1, seed=1, boundary_window=4):
+    # Returns the order to ride the segments in, as indices into segment_information.
+    if len(segment_information) == 0:
+        return []
+    starts = [x["latlngs"][0] for x in segment_information]
+    ends = [x["latlngs"][len(x["latlngs"]) - 1] for x in segment_information]
+    start_lats = np.array([float(x["lat"]) for x in starts])
+    start_lngs = np.array([float(x["lng"]) for x in starts])
+    end_lats = np.array([float(x["lat"]) for x in ends])
+    end_lngs = np.array([float(x["lng"]) for x in ends])
+
+    # Cluster on the middle of each segment's start and end.
+    points = project((start_lats + end_lats) / 2, (start_lngs + end_lngs) / 2)
+    clusters = split_clusters(points, max_cluster_size, seed)
+    centroids = [(float(np.mean(start_lats[c])), float(np.mean(start_lngs[c]))) for c in clusters]
+    clusters = [clusters[i] for i in order_clusters(start_latlng, centroids, time_budget_seconds)]
+    centroids = [(float(np.mean(start_lats[c])), float(np.mean(start_lngs[c]))) for c in clusters]
+    print("Split {} segments into {} clusters".format(len(segment_information), len(clusters)))
+
+    # Where the route comes from before each cluster and goes after it.
+    anchors = [(float(start_latlng["lat"]), float(start_latlng["lng"]))] + centroids + \
+              [(float(start_latlng["lat"]), float(start_latlng["lng"]))]
+
+    def cluster_problem(c):
+        members = clusters[c]
+        matrix = matrix_builder.build([ends[i] for i in members], [starts[i] for i in members],
+                                      skip_diagonal=True)
+        (before, after) = (anchors[c], anchors[c + 2])
+        entries = haversine_distances(before[0], before[1], start_lats[members], start_lngs[members], Unit.METERS)
+        exits = haversine_distances(end_lats[members], end_lngs[members], after[0], after[1], Unit.METERS)
+        return cluster_distances(matrix, [segment_information[i]["length"] for i in members],
+                                 entries.tolist(), exits.tolist())
+
+    with ThreadPoolExecutor(max_workers=matrix_builder.max_workers) as executor:
+        problems = list(executor.map(cluster_problem, range(len(clusters))))
+    print("Completed constructing distance matrices")
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        paths = list(executor.map(solve_cluster, problems))
+
+    order = []
+    boundaries = []
+    for (members, path) in zip(clusters, paths):
+        boundaries.append(len(order))
+        order.extend(int(members[i - 1]) for i in path if i != 0)
+
+    for boundary in boundaries[1:]:
+        improve_boundary(matrix_builder, start_latlng, segment_information, order,
+                         max(boundary - boundary_window, 0), min(boundary + boundary_window, len(order)))
+    return order
@@ -0,0 +1,59 @@
+# Fetches Google Maps directions for the legs of a route. Legs the cache already
+# has are reused, the rest are requested concurrently, and the results come back
+# in the order the legs were given no matter which request finishes first.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import googlemaps
+
+import metrics
+
+class DirectionsFetcher():
+    def __init__(self, gmaps, cache=None, mode="bicycling", max_workers=4):
+        self.gmaps = gmaps
+        self.cache = cache
+        self.mode = mode
+        self.max_workers = max_workers
+
+    def _key(self, latlng):
+        if self.cache is not None:
+            return self.cache.key(latlng)
+        return "{},{}".format(float(latlng["lat"]), float(latlng["lng"]))
+
+    def _fetch(self, origin, destination):
+        metrics.count("directions_requests")
+        with metrics.timer("directions_request"):
+            directions_result = self.gmaps.directions(origin, destination, mode=self.mode)
+        if len(directions_result) == 0:
+            raise Exception("No {} directions from {} to {}".format(self.mode, origin, destination))
+        return directions_result[0]["overview_polyline"]["points"]
+
+    def fetch(self, legs):
+        # Takes a list of (origin, destination) lat/lngs and returns the decoded
+        # directions for each, in the same order.
+        return [googlemaps.convert.decode_polyline(x) for x in self.fetch_polylines(legs)]
+
+    def fetch_polylines(self, legs):
+        # Like fetch, but the directions are left as encoded polylines, which
+        # take far less memory than decoded points. A leg that appears more than
+        # once is only looked up once.
+        keys = [(self._key(origin), self._key(destination)) for (origin, destination) in legs]
+        known = {}
+        if self.cache is not None:
+            known = self.cache.get_directions(set(keys), self.mode)
+
+        missing = {}
+        for (key, leg) in zip(keys, legs):
+            if key not in known and key not in missing:
+                missing[key] = leg
+        metrics.count("directions_cache_hits", len(set(keys)) - len(missing))
+        metrics.count("directions_cache_misses", len(missing))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            fetched = dict(zip(missing, executor.map(lambda leg: self._fetch(leg[0], leg[1]),
+                                                     missing.values())))
+
+        if self.cache is not None and len(fetched) > 0:
+            self.cache.put_directions(fetched, self.mode)
+        known.update(fetched)
+        return [known[key] for key in keys]
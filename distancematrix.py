@@ -0,0 +1,119 @@
+# Builds dense bicycling distance matrices between lists of lat/lngs, going to
+# the Google Maps distance matrix API only for the pairs the cache doesn't have.
+# Missing pairs are tiled into the largest blocks a single request allows and
+# the blocks are fetched concurrently.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# Limits of a single distance matrix request.
+MAX_ORIGINS_PER_REQUEST = 25
+MAX_DESTINATIONS_PER_REQUEST = 25
+MAX_ELEMENTS_PER_REQUEST = 100
+
+def tile(number_of_origins, number_of_destinations, limits=None):
+    # Splits an origins x destinations grid into blocks that fit in one request,
+    # as wide as possible so that few requests are needed. Returns a list of
+    # (origin range, destination range) pairs. limits is (max origins, max
+    # destinations, max elements) per request, where None means no limit.
+    if number_of_origins == 0 or number_of_destinations == 0:
+        return []
+    (max_origins, max_destinations, max_elements) = [
+        number_of_origins * number_of_destinations if x is None else x
+        for x in (limits or (MAX_ORIGINS_PER_REQUEST, MAX_DESTINATIONS_PER_REQUEST, MAX_ELEMENTS_PER_REQUEST))]
+    columns = min(number_of_destinations, max_destinations, max_elements)
+    rows = min(number_of_origins, max_origins, max_elements // max(columns, 1))
+    tiles = []
+    for row_start in range(0, number_of_origins, rows):
+        for column_start in range(0, number_of_destinations, columns):
+            tiles.append((range(row_start, min(row_start + rows, number_of_origins)),
+                          range(column_start, min(column_start + columns, number_of_destinations))))
+    return tiles
+
+class DistanceMatrixBuilder():
+    # gmaps is a googlemaps.Client or anything with the same distance_matrix
+    # method. Clients with other limits on the size of a request can say so with
+    # a request_limits attribute, in the form tile() takes.
+    def __init__(self, gmaps, cache=None, mode="bicycling", max_workers=4):
+        self.gmaps = gmaps
+        self.limits = getattr(gmaps, "request_limits", None)
+        self.cache = cache
+        self.mode = mode
+        self.max_workers = max_workers
+
+    def _key(self, latlng):
+        if self.cache is not None:
+            return self.cache.key(latlng)
+        return "{},{}".format(float(latlng["lat"]), float(latlng["lng"]))
+
+    def _fetch_tile(self, origins, destinations):
+        # Returns rows of meters, with None where there is no route.
+        metrics.count("distance_matrix_requests")
+        metrics.count("distance_matrix_elements", len(origins) * len(destinations))
+        with metrics.timer("distance_matrix_request"):
+            matrix = self.gmaps.distance_matrix(origins, destinations, mode=self.mode, units="metric")
+        return [[element["distance"]["value"] if element["status"] == "OK" else None
+                 for element in row["elements"]] for row in matrix["rows"]]
+
+    def build(self, origins, destinations, skip_diagonal=False):
+        # Returns matrix[i][j], the distance in meters from origins[i] to
+        # destinations[j]. With skip_diagonal the i == j entries aren't looked up
+        # and are left as 0, which is what the ordering code wants when origins
+        # and destinations are the ends and starts of the same segments.
+        origin_keys = [self._key(x) for x in origins]
+        destination_keys = [self._key(x) for x in destinations]
+        pairs = set()
+        for i in range(len(origins)):
+            for j in range(len(destinations)):
+                if skip_diagonal and i == j: continue
+                pairs.add((origin_keys[i], destination_keys[j]))
+
+        known = {}
+        if self.cache is not None:
+            known = self.cache.get_distances(pairs, self.mode)
+
+        # Reduce the missing pairs to the distinct origins and destinations
+        # involved, then fetch the tiles of that grid that contain a missing pair.
+        missing = pairs - set(known)
+        metrics.count("distance_cache_hits", len(known))
+        metrics.count("distance_cache_misses", len(missing))
+        missing_origins = sorted(set(origin for (origin, _) in missing))
+        missing_destinations = sorted(set(destination for (_, destination) in missing))
+        origin_latlngs = dict(zip(origin_keys, origins))
+        destination_latlngs = dict(zip(destination_keys, destinations))
+
+        requests = []
+        for (rows, columns) in tile(len(missing_origins), len(missing_destinations), self.limits):
+            tile_origins = [missing_origins[i] for i in rows]
+            tile_destinations = [missing_destinations[j] for j in columns]
+            if any((o, d) in missing for o in tile_origins for d in tile_destinations):
+                requests.append((tile_origins, tile_destinations))
+
+        fetched = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(
+                lambda request: self._fetch_tile([origin_latlngs[o] for o in request[0]],
+                                                 [destination_latlngs[d] for d in request[1]]),
+                requests)
+            for ((tile_origins, tile_destinations), values) in zip(requests, results):
+                for (origin, row) in zip(tile_origins, values):
+                    for (destination, meters) in zip(tile_destinations, row):
+                        # A tile can hold pairs that weren't asked for, like a
+                        # segment's end to its own start, and they may not have
+                        # a route. Only the missing pairs have to.
+                        if (origin, destination) not in missing: continue
+                        if meters is None:
+                            raise Exception("No {} route from {} to {}".format(self.mode, origin, destination))
+                        fetched[(origin, destination)] = meters
+
+        if self.cache is not None and len(fetched) > 0:
+            self.cache.put_distances(fetched, self.mode)
+        known.update(fetched)
+
+        matrix = [[0] * len(destinations) for i in range(len(origins))]
+        for i in range(len(origins)):
+            for j in range(len(destinations)):
+                if skip_diagonal and i == j: continue
+                matrix[i][j] = known[(origin_keys[i], destination_keys[j])]
+        return matrix
@@ -0,0 +1,191 @@
+# Offline stand-ins for the external services, so route building can be run and
+# timed without network access or API keys.
+
+import hashlib
+import json
+import math
+import random
+
+import googlemaps
+from haversine import haversine, Unit
+
+class FakeMapsClient():
+    # Mimics the parts of googlemaps.Client that routebuilder uses. Distances
+    # are the straight line distance times a detour factor, and directions are
+    # a straight line between the two points.
+    def __init__(self, detour_factor=1.3):
+        self.detour_factor = detour_factor
+        self.distance_matrix_calls = 0
+        self.distance_matrix_elements = 0
+        self.directions_calls = 0
+
+    def _latlng(self, latlng):
+        if isinstance(latlng, str):
+            (lat, lng) = latlng.split(',')
+            return (float(lat), float(lng))
+        if isinstance(latlng, dict):
+            return (float(latlng["lat"]), float(latlng["lng"]))
+        return (float(latlng[0]), float(latlng[1]))
+
+    def _meters(self, origin, destination):
+        return int(self.detour_factor * haversine(self._latlng(origin), self._latlng(destination),
+                                                  unit=Unit.METERS))
+
+    def distance_matrix(self, origins, destinations, mode=None, units=None):
+        self.distance_matrix_calls = self.distance_matrix_calls + 1
+        self.distance_matrix_elements = self.distance_matrix_elements + len(origins) * len(destinations)
+        rows = []
+        for origin in origins:
+            elements = []
+            for destination in destinations:
+                meters = self._meters(origin, destination)
+                elements.append({"status": "OK",
+                                 "distance": {"value": meters},
+                                 "duration": {"value": meters // 5}})
+            rows.append({"elements": elements})
+        return {"status": "OK", "rows": rows}
+
+    def directions(self, origin, destination, mode=None):
+        self.directions_calls = self.directions_calls + 1
+        (start, end) = (self._latlng(origin), self._latlng(destination))
+        polyline = googlemaps.convert.encode_polyline([start, end])
+        return [{"overview_polyline": {"points": polyline}}]
+
+class FakeResponse():
+    # body is served as JSON, or as is if it is a string, which json() then
+    # fails to parse like requests does.
+    def __init__(self, status_code, body, headers=None):
+        self.status_code = status_code
+        self.text = body if isinstance(body, str) else json.dumps(body)
+        self.headers = headers if headers is not None else {}
+
+    def json(self):
+        return json.loads(self.text)
+
+class FakeStravaClient():
+    # Stands in for the HttpClient SegmentLoader downloads segments with. Any
+    # segment id is a made up straight segment of 500 to 3000 meters somewhere
+    # within radius_meters of center, always the same one for the same id.
+    def __init__(self, center=(41.44816, -79.9302), radius_meters=10000):
+        self.center = center
+        self.radius_meters = radius_meters
+        self.request_calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.request_calls = self.request_calls + 1
+        segment_id = url.rstrip("/").rsplit("/", 1)[1]
+        if method != "GET" or not segment_id.isdigit():
+            return FakeResponse(404, {"message": "Record Not Found"})
+        rng = random.Random(int(segment_id))
+        (distance, bearing, length) = (self.radius_meters * math.sqrt(rng.random()),
+                                       rng.uniform(0, 2 * math.pi), rng.uniform(500, 3000))
+        # Meters per degree of latitude and longitude.
+        lat_scale = 111320.0
+        lng_scale = lat_scale * math.cos(math.radians(self.center[0]))
+        start = (self.center[0] + distance * math.cos(bearing) / lat_scale,
+                 self.center[1] + distance * math.sin(bearing) / lng_scale)
+        heading = rng.uniform(0, 2 * math.pi)
+        end = (start[0] + length * math.cos(heading) / lat_scale,
+               start[1] + length * math.sin(heading) / lng_scale)
+        return FakeResponse(200, {"id": int(segment_id), "name": "Segment {}".format(segment_id),
+                                  "distance": length,
+                                  "map": {"polyline": googlemaps.convert.encode_polyline([start, end])}})
+
+class FakeStarClient():
+    # Stands in for the HttpClient SegmentStarrer uses. Segments in starred are
+    # already starred, and starring a segment in html_errors gets a 200 with an
+    # HTML page instead of JSON, like a proxy error page.
+    def __init__(self, starred=(), html_errors=()):
+        self.starred = set(str(x) for x in starred)
+        self.html_errors = set(str(x) for x in html_errors)
+        self.request_calls = 0
+
+    def pause(self, seconds):
+        pass
+
+    def request(self, method, url, **kwargs):
+        self.request_calls = self.request_calls + 1
+        if method == "GET" and url.endswith("/segments/starred"):
+            (page, per_page) = (kwargs["params"]["page"], kwargs["params"]["per_page"])
+            ids = sorted(self.starred)[(page - 1) * per_page:page * per_page]
+            return FakeResponse(200, [{"id": int(x)} for x in ids])
+        segment_id = url.rstrip("/").rsplit("/", 2)[1]
+        if method != "PUT" or not segment_id.isdigit():
+            return FakeResponse(404, {"message": "Record Not Found"})
+        if segment_id in self.html_errors:
+            return FakeResponse(200, "<html><body>Bad Gateway</body></html>")
+        self.starred.add(segment_id)
+        return FakeResponse(200, {"id": int(segment_id), "name": "Segment {}".format(segment_id)})
+
+def format_seconds(seconds):
+    # Formats a time the way Strava leaderboards show it.
+    if seconds < 60:
+        return "{}".format(seconds)
+    if seconds < 3600:
+        return "{}:{:02d}".format(seconds // 60, seconds % 60)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+def leaderboard_page(rows, first_rank=1):
+    # Renders (athlete, seconds) rows as a partial leaderboard page like the
+    # one Strava returns for segments/{id}?partial=true.
+    lines = ['<table class="table table-striped table-leaderboard"><thead><tr>',
+             '<th class="rank">Rank</th><th class="athlete">Name</th><th>Date</th>',
+             '<th>Speed</th><th class="last-child">Time</th></tr></thead><tbody>']
+    for (rank, (athlete, seconds)) in enumerate(rows, first_rank):
+        lines.append(
+            '<tr><td class="rank">{}</td>'
+            '<td class="athlete track-click" data-tracking-element="leaderboard_effort">'
+            '<div class="avatar avatar-athlete avatar-sm"></div>'
+            '<a href="/athletes/{}">{}</a></td>'
+            '<td class="date">Aug 3, 2020</td><td>20.1<abbr class="unit" title="miles per hour">mi/h</abbr></td>'
+            '<td class="last-child">{}</td></tr>'.format(rank, rank, athlete, format_seconds(seconds)))
+    lines.append('</tbody></table>')
+    return "\n".join(lines)
+
+class FakeLeaderboardFetcher():
+    # Serves leaderboard pages for SegmentCrawler from in memory rankings, a map
+    # of segment id -> option -> sorted list of (athlete, seconds).
+    def __init__(self, leaderboards):
+        self.leaderboards = leaderboards
+        self.fetch_calls = 0
+
+    def fetch(self, url):
+        self.fetch_calls = self.fetch_calls + 1
+        (path, query) = url.split("?", 1)
+        segment = path.rsplit("/", 1)[1]
+        params = query.split("&")
+        page = int([x for x in params if x.startswith("page=")][0][len("page="):])
+        per_page = int([x for x in params if x.startswith("per_page=")][0][len("per_page="):])
+        option = "&".join(x for x in params
+                          if x != "partial=true" and not x.startswith("page=") and not x.startswith("per_page="))
+        rows = self.leaderboards[segment][option]
+        start = (page - 1) * per_page
+        return leaderboard_page(rows[start:start + per_page], start + 1)
+
+class GeneratedLeaderboards(dict):
+    # Leaderboards for FakeLeaderboardFetcher that are made up the first time a
+    # segment is asked for, so any segment id has one. Each option of a segment
+    # has a different mix of the same pool of riders.
+    def __init__(self, riders=250, pool=1000):
+        super().__init__()
+        self.riders = riders
+        self.pool = pool
+
+    def __missing__(self, segment):
+        self[segment] = GeneratedOptions(segment, self.riders, self.pool)
+        return self[segment]
+
+class GeneratedOptions(dict):
+    def __init__(self, segment, riders, pool):
+        super().__init__()
+        self.segment = segment
+        self.riders = riders
+        self.pool = pool
+
+    def __missing__(self, option):
+        seed = hashlib.sha1("{}?{}".format(self.segment, option).encode("utf-8")).hexdigest()
+        rng = random.Random(seed)
+        athletes = rng.sample(range(self.pool), min(self.riders, self.pool))
+        self[option] = sorted([("Rider {}".format(x), rng.randint(120, 1800)) for x in athletes],
+                              key=lambda a : a[1])
+        return self[option]
@@ -0,0 +1,103 @@
+# Vectorized distance calculations over routes. A route is held as two
+# contiguous float64 arrays of latitudes and longitudes, and haversine distances
+# for every leg are computed in a single numpy pass instead of a Python call per
+# pair of points. Routes can also be thinned out with Douglas-Peucker.
+
+import numpy as np
+from haversine import Unit
+
+# Mean earth radius, the same one the haversine library uses.
+EARTH_RADIUS_KM = 6371.0088
+
+UNITS_PER_KM = {
+    Unit.KILOMETERS: 1.0,
+    Unit.METERS: 1000.0,
+    Unit.MILES: 0.621371192,
+}
+
+def haversine_distances(lats1, lngs1, lats2, lngs2, unit=Unit.MILES):
+    # Elementwise haversine distance between two sets of points given in degrees.
+    lats1 = np.radians(lats1)
+    lats2 = np.radians(lats2)
+    dlat = lats2 - lats1
+    dlng = np.radians(lngs2) - np.radians(lngs1)
+    d = np.sin(dlat * 0.5) ** 2 + np.cos(lats1) * np.cos(lats2) * np.sin(dlng * 0.5) ** 2
+    return 2 * EARTH_RADIUS_KM * UNITS_PER_KM[unit] * np.arcsin(np.sqrt(d))
+
+class Route():
+    def __init__(self, lats, lngs):
+        self.lats = np.ascontiguousarray(lats, dtype=np.float64)
+        self.lngs = np.ascontiguousarray(lngs, dtype=np.float64)
+
+    @classmethod
+    def from_latlngs(cls, latlngs):
+        # Takes the {"lat": ..., "lng": ...} dicts used everywhere else. Values
+        # may be strings when they come from the command line.
+        lats = np.fromiter((float(x["lat"]) for x in latlngs), dtype=np.float64, count=len(latlngs))
+        lngs = np.fromiter((float(x["lng"]) for x in latlngs), dtype=np.float64, count=len(latlngs))
+        return cls(lats, lngs)
+
+    def __len__(self):
+        return len(self.lats)
+
+    def leg_distances(self, unit=Unit.MILES):
+        # Distance between each consecutive pair of points, one shorter than the route.
+        return haversine_distances(self.lats[:-1], self.lngs[:-1], self.lats[1:], self.lngs[1:], unit)
+
+    def cumulative_distances(self, unit=Unit.MILES):
+        # Distance travelled when reaching each point, starting at 0.
+        result = np.zeros(len(self))
+        np.cumsum(self.leg_distances(unit), out=result[1:])
+        return result
+
+    def length(self, unit=Unit.MILES):
+        return float(np.sum(self.leg_distances(unit)))
+
+    def distances_from(self, latlng, unit=Unit.MILES):
+        # Straight line distance from one point to every point of the route.
+        return haversine_distances(float(latlng["lat"]), float(latlng["lng"]), self.lats, self.lngs, unit)
+
+    def _projected(self):
+        # Meters east and north of the first point. Flat earth is plenty accurate
+        # at the scale of a single leg of a ride.
+        meters_per_degree = EARTH_RADIUS_KM * 1000 * np.pi / 180
+        x = (self.lngs - self.lngs[0]) * meters_per_degree * np.cos(np.radians(self.lats[0]))
+        y = (self.lats - self.lats[0]) * meters_per_degree
+        return (x, y)
+
+    def simplified_indices(self, tolerance_meters):
+        # Douglas-Peucker: returns the sorted indices of the points to keep so that
+        # no dropped point is more than tolerance_meters from the simplified
+        # line. The first and last points are always kept.
+        n = len(self)
+        if n <= 2 or tolerance_meters <= 0:
+            return np.arange(n)
+        (x, y) = self._projected()
+        keep = np.zeros(n, dtype=bool)
+        keep[0] = True
+        keep[n - 1] = True
+
+        # An explicit stack of (first, last) ranges instead of recursion, with the
+        # distances of every point in a range measured in one numpy pass.
+        stack = [(0, n - 1)]
+        while len(stack) > 0:
+            (first, last) = stack.pop()
+            if last - first < 2: continue
+            dx = x[last] - x[first]
+            dy = y[last] - y[first]
+            px = x[first + 1:last] - x[first]
+            py = y[first + 1:last] - y[first]
+            length_squared = dx * dx + dy * dy
+            if length_squared == 0:
+                distances = np.hypot(px, py)
+            else:
+                # Distance to the chord, clamped to its endpoints.
+                t = np.clip((px * dx + py * dy) / length_squared, 0, 1)
+                distances = np.hypot(px - t * dx, py - t * dy)
+            farthest = int(np.argmax(distances))
+            if distances[farthest] > tolerance_meters:
+                middle = first + 1 + farthest
+                keep[middle] = True
+                stack.append((first, middle))
+                stack.append((middle, last))
+        return np.flatnonzero(keep)
@@ -1,11 +1,213 @@
-# From https://github.com/CarlEkerot/held-karp
+# held_karp_reference is from https://github.com/CarlEkerot/held-karp
 
 import itertools
 import random
 import sys
 
+import numpy as np
+
+import metrics
+
 
 def held_karp(dists):
+    """
+    Array backed implementation of Held-Karp. The DP table is a dense
+    (2^(n-1), n-1) array indexed by the bitmask of visited nodes (node 0, the
+    start, is implicit) and the last node visited. Subsets are processed in
+    layers of equal size, and every transition in a layer is computed as a
+    vectorized min-reduction, which makes 18-20 nodes practical.
+    Parameters:
+        dists: distance matrix
+    Returns:
+        The optimal path as a list of node indices starting at 0.
+    """
+    n = len(dists)
+    if n <= 2:
+        return list(range(n))
+
+    dists = np.asarray(dists, dtype=np.float64)
+    m = n - 1
+    number_of_subsets = 1 << m
+
+    # Costs between the non start nodes, and from/to the start node.
+    inner = dists[1:, 1:]
+    from_start = dists[0, 1:]
+    to_start = dists[1:, 0]
+
+    # C[bits, k] is the lowest cost to start at node 0, visit every node in
+    # bits and end at node k + 1. Unreachable states stay at infinity so they
+    # never win a min-reduction. P holds the node visited before k.
+    C = np.full((number_of_subsets, m), np.inf)
+    P = np.zeros((number_of_subsets, m), dtype=np.int8)
+
+    # Set transition cost from initial state
+    singles = 1 << np.arange(m)
+    C[singles, np.arange(m)] = from_start
+
+    # Number of set bits of every subset, used to pick out each layer.
+    all_bits = np.arange(number_of_subsets)
+    popcount = np.zeros(number_of_subsets, dtype=np.int8)
+    for bit in range(m):
+        popcount += (all_bits >> bit) & 1
+
+    for subset_size in range(2, n):
+        layer = np.flatnonzero(popcount == subset_size)
+        for k in range(m):
+            subsets = layer[(layer >> k) & 1 == 1]
+            prev = subsets & ~(1 << k)
+
+            # Cost of reaching prev ending at every m, then moving from m to k.
+            costs = C[prev] + inner[:, k]
+            best = np.argmin(costs, axis=1)
+            C[subsets, k] = costs[np.arange(len(subsets)), best]
+            P[subsets, k] = best
+            metrics.count("heldkarp_states", len(subsets))
+
+    bits = number_of_subsets - 1
+    parent = int(np.argmin(C[bits] + to_start))
+
+    # Backtrack to find full path
+    path = []
+    for i in range(m):
+        path.append(parent + 1)
+        new_bits = bits & ~(1 << parent)
+        parent = int(P[bits, parent])
+        bits = new_bits
+
+    # Add implicit start state
+    path.append(0)
+
+    return list(reversed(path))
+
+
+def nearest_neighbor_k(dists, k):
+    # The cheapest of the nearest neighbor loops through k nodes, trying every
+    # node as the first one. Used as the starting upper bound for the best k
+    # search. Returns (cost, path).
+    n = len(dists)
+    best = (np.inf, None)
+    for first in range(1, n):
+        path = [0, first]
+        cost = dists[0][first]
+        remaining = set(range(1, n)) - {first}
+        while len(path) < k + 1:
+            last = path[len(path) - 1]
+            closest = min(remaining, key=lambda j: (dists[last][j], j))
+            cost = cost + dists[last][closest]
+            path.append(closest)
+            remaining.remove(closest)
+        cost = cost + dists[path[len(path) - 1]][0]
+        if cost < best[0]:
+            best = (cost, path)
+    return best
+
+
+def held_karp_best_k(dists, k):
+    """
+    The cheapest loop from node 0 that visits exactly k of the other nodes.
+    Works like held_karp but only builds subsets up to size k, and each layer
+    is generated from the subsets of the one before that survive pruning.
+    A state is pruned when its cost plus a lower bound on finishing the loop,
+    built from the k - size cheapest edges into any node and the cheapest
+    edge back to 0, can't beat the best loop found by nearest neighbor.
+    Parameters:
+        dists: distance matrix
+        k: the number of nodes besides 0 to visit
+    Returns:
+        The optimal path as a list of node indices starting at 0.
+    """
+    n = len(dists)
+    if k >= n - 1:
+        return held_karp(dists)
+    if k <= 0:
+        return [0]
+
+    dists = np.asarray(dists, dtype=np.float64)
+    m = n - 1
+    inner = dists[1:, 1:].copy()
+    np.fill_diagonal(inner, np.inf)
+    from_start = dists[0, 1:]
+    to_start = dists[1:, 0]
+
+    # Lower bounds on what is left to do after a state.
+    incoming = np.min(np.vstack((inner, from_start[None, :])), axis=0)
+    cheapest_incoming = np.concatenate(([0.0], np.cumsum(np.sort(incoming))))
+    cheapest_return = np.min(to_start)
+    (upper_bound, best_path) = nearest_neighbor_k(dists, k)
+    upper_bound = upper_bound + 1e-9
+
+    def prune(costs, subset_size):
+        remaining = k - subset_size
+        if remaining == 0:
+            bound = costs + to_start[None, :]
+        else:
+            bound = costs + cheapest_incoming[remaining] + cheapest_return
+        costs[bound > upper_bound] = np.inf
+        return costs
+
+    # Every layer is a sorted array of subset bitmasks, the cost of each subset
+    # ending at each node (infinity if it can't, or was pruned) and the node
+    # visited before that one.
+    subsets = np.sort(1 << np.arange(m, dtype=np.int64))
+    costs = np.full((m, m), np.inf)
+    costs[np.arange(m), np.arange(m)] = from_start
+    costs = prune(costs, 1)
+    layers = [(subsets, np.zeros((m, m), dtype=np.int8))]
+
+    for subset_size in range(2, k + 1):
+        alive = np.any(np.isfinite(costs), axis=1)
+        (subsets, costs) = (subsets[alive], costs[alive])
+        layers[len(layers) - 1] = (layers[len(layers) - 1][0][alive], layers[len(layers) - 1][1][alive])
+        if len(subsets) == 0:
+            break
+
+        # Extend every surviving subset by every node it doesn't have.
+        extended = [(subsets[(subsets >> j) & 1 == 0] | (1 << j)) for j in range(m)]
+        next_subsets = np.unique(np.concatenate(extended))
+
+        next_costs = np.full((len(next_subsets), m), np.inf)
+        parents = np.zeros((len(next_subsets), m), dtype=np.int8)
+        for j in range(m):
+            rows = np.flatnonzero((next_subsets >> j) & 1 == 1)
+            prev = next_subsets[rows] & ~(1 << j)
+            index = np.minimum(np.searchsorted(subsets, prev), len(subsets) - 1)
+            found = subsets[index] == prev
+            (rows, index) = (rows[found], index[found])
+
+            # Cost of reaching prev ending at every node, then moving to j.
+            step = costs[index] + inner[:, j]
+            best = np.argmin(step, axis=1)
+            next_costs[rows, j] = step[np.arange(len(rows)), best]
+            parents[rows, j] = best
+
+        (subsets, costs) = (next_subsets, prune(next_costs, subset_size))
+        layers.append((subsets, parents))
+
+    if len(subsets) == 0 or not np.any(np.isfinite(costs)):
+        # Nothing beat the nearest neighbor loop.
+        return best_path
+
+    totals = costs + to_start[None, :]
+    (row, parent) = np.unravel_index(int(np.argmin(totals)), totals.shape)
+    bits = int(subsets[row])
+    metrics.count("heldkarp_states", sum(len(layer[0]) for layer in layers) * m)
+
+    # Backtrack through the layers to find the full path.
+    path = []
+    for (layer_subsets, layer_parents) in reversed(layers):
+        row = int(np.searchsorted(layer_subsets, bits))
+        path.append(int(parent) + 1)
+        new_bits = bits & ~(1 << int(parent))
+        parent = int(layer_parents[row, parent])
+        bits = new_bits
+
+    # Add implicit start state
+    path.append(0)
+
+    return list(reversed(path))
+
+
+def held_karp_reference(dists):
     """
     Implementation of Held-Karp, an algorithm that solves the Traveling
     Salesman Problem using dynamic programming with memoization.
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3.8
+
+# Compares the array backed Held-Karp against the original memoized version
+# on random asymmetric distance matrices of increasing size.
+
+import argparse
+import random
+import time
+
+import heldkarp
+
+def random_distances(n, seed):
+    rng = random.Random(seed)
+    return [[0 if i == j else rng.randint(100, 20000) for j in range(n)] for i in range(n)]
+
+def path_cost(dists, path):
+    return sum(dists[path[i]][path[(i + 1) % len(path)]] for i in range(len(path)))
+
+def time_solver(solver, dists):
+    start = time.perf_counter()
+    path = solver(dists)
+    return time.perf_counter() - start, path
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the Held-Karp implementations across numbers of nodes"
+    )
+
+    parser.add_argument("--min_nodes", type=int, required=False, default=4)
+    parser.add_argument("--max_nodes", type=int, required=False, default=18)
+    parser.add_argument("--max_reference_nodes", type=int, required=False, default=13,
+                        help="The largest size to run the original implementation on, it gets slow quickly")
+    parser.add_argument("--seed", type=int, required=False, default=1)
+    args = parser.parse_args()
+
+    print("nodes,array_seconds,reference_seconds,speedup")
+    for n in range(args.min_nodes, args.max_nodes + 1):
+        dists = random_distances(n, args.seed + n)
+        array_seconds, array_path = time_solver(heldkarp.held_karp, dists)
+
+        if n > args.max_reference_nodes:
+            print("{},{:.4f},,".format(n, array_seconds))
+            continue
+
+        reference_seconds, reference_path = time_solver(heldkarp.held_karp_reference, dists)
+        if path_cost(dists, array_path) != path_cost(dists, reference_path):
+            raise Exception("Held-Karp implementations disagree for {} nodes".format(n))
+        print("{},{:.4f},{:.4f},{:.1f}x".format(
+            n, array_seconds, reference_seconds, reference_seconds / max(array_seconds, 1e-9)))
+
+if __name__ == "__main__":
+    main()
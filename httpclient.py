@@ -0,0 +1,102 @@
+# Shared HTTP plumbing for the tools that talk to Strava. One pooled session with
+# keep-alive connections replaces forking a curl process per request, and
+# requests that get rate limited or hit a server error are retried with backoff.
+
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+class HttpError(Exception):
+    def __init__(self, url, status_code, body):
+        super().__init__("Request to {} failed with status {}".format(url, status_code))
+        self.url = url
+        self.status_code = status_code
+        self.body = body
+
+def load_cookie_file(session, cookie_file):
+    # Loads a netscape/mozilla format cookie file, the same format curl's
+    # --cookie takes, into the session.
+    with open(cookie_file, "r") as file:
+        for line in file:
+            if line.startswith("#HttpOnly_"):
+                line = line[len("#HttpOnly_"):]
+            elif line.startswith("#") or not line.strip():
+                continue
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) != 7: continue
+            (domain, _, path, _, _, name, value) = fields
+            session.cookies.set(name, value, domain=domain, path=path)
+
+class HttpClient():
+    def __init__(self, cookie_file=None, headers=None, pool_size=8, max_retries=5,
+                 backoff_seconds=1.0, timeout_seconds=30):
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout_seconds = timeout_seconds
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if headers is not None:
+            self.session.headers.update(headers)
+        if cookie_file is not None:
+            load_cookie_file(self.session, cookie_file)
+
+        # When any request is rate limited every thread waits, rather than each
+        # of them hammering the server until it gets its own 429.
+        self.lock = threading.Lock()
+        self.paused_until = 0
+
+    def _wait_if_paused(self):
+        with self.lock:
+            delay = self.paused_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def _retry_delay(self, response, attempt):
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after is not None and retry_after.isdigit():
+                return int(retry_after)
+        return self.backoff_seconds * (2 ** attempt)
+
+    def request(self, method, url, **kwargs):
+        attempt = 0
+        while True:
+            self._wait_if_paused()
+            metrics.count("http_requests")
+            try:
+                with metrics.timer("http_request"):
+                    response = self.session.request(method, url, timeout=self.timeout_seconds, **kwargs)
+                metrics.count("http_bytes_downloaded", len(response.content))
+            except requests.ConnectionError:
+                if attempt >= self.max_retries: raise
+                response = None
+
+            if response is not None and response.status_code != 429 and response.status_code < 500:
+                return response
+            if attempt >= self.max_retries:
+                return response
+
+            metrics.count("http_retries")
+            delay = self._retry_delay(response, attempt)
+            if response is not None and response.status_code == 429:
+                self.pause(delay)
+            else:
+                time.sleep(delay)
+            attempt = attempt + 1
+
+    def fetch(self, url):
+        # Returns the body of a successful GET, raising HttpError otherwise.
+        response = self.request("GET", url)
+        if response.status_code >= 400:
+            raise HttpError(url, response.status_code, response.text)
+        return response.text
@@ -1,31 +1,13 @@
 import sys
+import athleteindex
 import leaderboard
+import metrics
 import json
 import argparse
 
-class SegmentIndividualAggregator(leaderboard.SegmentRankingsGatherer):
-    def __init__(self,  segment, config, run_config, name, stats):
-         super().__init__(segment, config, run_config)
-         self.stats = stats
-         self.name = name
-
-    def process_rankings(self, rankings):
-        prev_time = -1
-        rank = 1
-        count = 1
-
-        # Olympic tie breaking rules, if the same people get the same time they get
-        # the same number of points, then the next person gets the N-1st next points slot,
-        # where N is the number of ties. So if the points are 35, 30, 25, 20 and the first
-        # two people tie, then the first two get 35 and the next gets 25, not 30.
-        for (name, time) in rankings:
-            if time != prev_time:
-                rank = count
-            count = count + 1
-            prev_time = time
-            if name == self.name:
-                self.stats.append("{},{},{}".format(self.segment, rank, len(rankings)))
-                break
+def ranking_lines(index, name):
+    # segment,rank,total_num_riders for each segment the athlete is on.
+    return ["{},{},{}".format(result.segment, result.rank, result.field_size) for result in index.get(name)]
 
 def main():
     parser = argparse.ArgumentParser(
@@ -34,10 +16,25 @@ def main():
 
     parser.add_argument("--config_file", type=str, required=True)
     parser.add_argument("--cookie_file", type=str, required=True)
-    parser.add_argument("--name", type=str, required=True)
-    parser.add_argument("--output_file", type=str, required=True)
+    parser.add_argument("--name", type=str, required=False, default=None)
+    parser.add_argument("--output_file", type=str, required=False, default=None)
+    parser.add_argument("--names_file", type=str, required=False, default=None,
+                        help=("""A file with one athlete name per line to use instead of name.
+                                 The leaderboards are crawled once and a CSV is written for each
+                                 athlete in output_dir"""))
+    parser.add_argument("--output_dir", type=str, required=False, default=None,
+                        help="Where the CSV for each athlete in names_file is written")
+    parser.add_argument("--concurrency", type=int, required=False, default=4,
+                        help="The number of leaderboards to crawl at once")
+    metrics.add_argument(parser)
 
     args = parser.parse_args()
+    if (args.name is None) == (args.names_file is None):
+        parser.error("one of --name or --names_file is required")
+    if args.name is not None and args.output_file is None:
+        parser.error("--output_file is required with --name")
+    if args.names_file is not None and args.output_dir is None:
+        parser.error("--output_dir is required with --names_file")
 
     config_file = open(args.config_file, "r")
     config_file_contents = config_file.read()
@@ -46,14 +43,22 @@ def main():
     config = leaderboard.Config(json_config, cookie_file)
 
     # TODO: Output per config, not just the first one.
-    stats = []
-    for segment in config.segments:
-            aggregator = SegmentIndividualAggregator(segment, config, config.run_configs[0], args.name, stats)
-            aggregator.run()
-
-    with open(args.output_file, 'w') as file:
-            for stat in stats:
-                file.write(stat + "\n")
+    snapshot = leaderboard.LeaderboardSnapshot(
+        leaderboard.SegmentCrawler(cookie_file, max_workers=args.concurrency), config)
+    with metrics.timer("rankings"):
+        index = athleteindex.build_index(snapshot, config, config.run_configs[0])
+
+    if args.name is not None:
+        output_files = {args.name: args.output_file}
+    else:
+        output_files = athleteindex.output_files(args.output_dir, athleteindex.read_names(args.names_file))
+    for (name, output_file) in output_files.items():
+        if name not in index:
+            print("{} isn't on any of the leaderboards".format(name))
+        with open(output_file, 'w') as file:
+            for line in ranking_lines(index, name):
+                file.write(line + "\n")
+    metrics.report(args.metrics)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,47 @@
+# Lets a tool hand its work to a running routeserver.py instead of doing it
+# itself, so it gets the server's warm caches. The tool's parsed arguments are
+# sent as the job, with file paths made absolute since the server may have been
+# started from another directory. Files are still read and written by the
+# server, so it has to run on the same machine.
+
+import json
+import os
+import urllib.error
+import urllib.request
+
+DEFAULT_SERVER = "http://127.0.0.1:8642"
+
+class JobFailedError(Exception):
+    pass
+
+def add_argument(parser):
+    parser.add_argument("--server", type=str, required=False, default=None, nargs="?", const=DEFAULT_SERVER,
+                        help=("""If set, the work is sent to the routeserver.py running at this
+                                 url ({} if no url is given) instead of being done here""".format(DEFAULT_SERVER)))
+
+def job_arguments(args, paths):
+    # The arguments as a JSON object, with the ones named in paths made absolute.
+    arguments = dict(vars(args))
+    del arguments["server"]
+    for name in paths:
+        if arguments.get(name):
+            arguments[name] = os.path.abspath(arguments[name])
+    return arguments
+
+def request(server, method, path, body=None, timeout=None):
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    request = urllib.request.Request(server.rstrip("/") + path, data=data, method=method,
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        raise JobFailedError("HTTP {}: {}".format(e.code, e.read().decode("utf-8", "replace")[:200]))
+
+def submit(server, kind, args, paths=()):
+    # Runs a job on the server, waiting for it to finish, and returns its result.
+    job = request(server, "POST", "/jobs",
+                  {"kind": kind, "arguments": job_arguments(args, paths), "wait": True})
+    if job["status"] != "done":
+        raise JobFailedError("Job {} {}: {}".format(job["id"], job["status"], job.get("error")))
+    return job["result"]
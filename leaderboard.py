@@ -1,15 +1,101 @@
 from html.parser import HTMLParser
 from collections import namedtuple
 import sys
-import subprocess
+import hashlib
+import html
+import re
 import json
 import time
 import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
+import jobclient
+import metrics
+from snapshotstore import SnapshotStore
+
+STRAVA_URL = "https://www.strava.com"
+
 CollectedData = namedtuple('Data', 'rankings, segment_count')
 
+def parse_seconds(data):
+    seconds = 0
+    parts = data.split(":")
+    if len(parts) == 1:
+        seconds = int(data)
+    elif len(parts) == 2:
+        # Format is mm:ss
+        seconds = 60* int(parts[0]) + int(parts[1])
+    elif len(parts) == 3:
+        # Format is hh:mm:ss
+        seconds = 3600 * int(parts[0]) + 60 * int(parts[1]) + int(parts[2])
+    return seconds
+
+class LeaderboardRowExtractor():
+    # Pulls (athlete, seconds) rows straight out of leaderboard page bytes. A row
+    # is the athlete cell, the text of the first link in it, and the text of the
+    # following last-child cell, the same things SegmentHTMLParser looks for,
+    # but found with one regular expression instead of a callback per tag.
+    # Pages can be fed in pieces as they arrive, rows are returned as soon as
+    # they are complete.
+    ROW = re.compile(
+        rb'<td\s[^>]*?\bclass=["\']athlete track-click["\'][^>]*>'
+        rb'.*?<a\b[^>]*>(?:<[^>]*>)*([^<]+)'
+        rb'.*?<td\s[^>]*?\bclass=["\']last-child["\'][^>]*>(?:<[^>]*>)*([^<]+)<',
+        re.DOTALL)
+    ROW_START = b'athlete track-click'
+
+    def __init__(self):
+        self.buffer = b''
+        self.count = 0
+
+    def feed(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        buffer = self.buffer + data
+
+        rows = []
+        end = 0
+        for match in self.ROW.finditer(buffer):
+            rows.append((html.unescape(match.group(1).decode("utf-8")),
+                         parse_seconds(match.group(2).decode("utf-8"))))
+            end = match.end() - 1
+
+        # Keep what might be the start of a row that isn't complete yet, either
+        # from the athlete cell or from the last tag, which may be cut off.
+        start = buffer.find(self.ROW_START, end)
+        if start == -1:
+            start = len(buffer)
+        start = buffer.rfind(b'<', end, start)
+        self.buffer = buffer[start:] if start != -1 else b''
+
+        self.count = self.count + len(rows)
+        return rows
+
+def iter_rows(chunks):
+    # Yields the (athlete, seconds) rows of a page given as an iterable of chunks.
+    extractor = LeaderboardRowExtractor()
+    for chunk in chunks:
+        for row in extractor.feed(chunk):
+            yield row
+
+class RowExtractorParser():
+    # Adapts LeaderboardRowExtractor to the parser interface SegmentCrawler
+    # uses, appending the rows of every page fed to it to results.
+    def __init__(self, results):
+        self.results = results
+        self.extractor = LeaderboardRowExtractor()
+
+    @property
+    def count(self):
+        return self.extractor.count
+
+    def feed(self, page):
+        rows = self.extractor.feed(page)
+        metrics.count("rows_parsed", len(rows))
+        self.results.extend(rows)
+
 class SegmentHTMLParser(HTMLParser):
     class State(Enum):
         INITIAL = 1
@@ -48,16 +134,7 @@ class SegmentHTMLParser(HTMLParser):
 
     def handle_data(self, data):
         if self.state is self.State.FOUND_TIME:
-            seconds = 0
-            parts = data.split(":")
-            if len(parts) is 1:
-                seconds = int(data)
-            elif len(parts) is 2:
-                # Format is mm:ss
-                seconds = 60* int(parts[0]) + int(parts[1])
-            elif len(parts) is 3:
-                # Format is hh:mm:ss
-                seconds = 3600 * int(parts[0]) + 60 * int(parts[1]) + int(parts[2])
+            seconds = parse_seconds(data)
             # TODO: If its already in the map, throw exception?
             self.handle_person(self.person, seconds)
             self.count = self.count + 1
@@ -68,65 +145,208 @@ class SegmentHTMLParser(HTMLParser):
             self.person = data
             self.state = self.state.SET_PERSON
 
-class TimeMapSegmentHTMLParser(SegmentHTMLParser):
-    def __init__(self, time_map, config):
-        self.time_map = time_map
+class ResultsSegmentHTMLParser(SegmentHTMLParser):
+    def __init__(self, results, config):
+        self.results = results
         super().__init__(config)
 
     def handle_person(self, person, seconds):
-        self.time_map[person] = seconds
+        self.results.append((person, seconds))
+
+def fingerprint_rows(rows):
+    # Identifies a page by the (athlete, seconds) rows on it. Live pages carry
+    # markup that changes from one request to the next, like relative dates and
+    # avatar urls, so the page bytes can differ when the rankings haven't.
+    return hashlib.sha1(json.dumps(rows).encode("utf-8")).hexdigest()
+
+class FingerprintingPageParser():
+    # Parses each page fed to it, keeping the (fingerprint, rows) of every page
+    # in pages.
+    def __init__(self, config, pages):
+        self.config = config
+        self.pages = pages
+        self.count = 0
+
+    def feed(self, page):
+        rows = []
+        RowExtractorParser(rows).feed(page)
+        self.pages.append((fingerprint_rows(rows), rows))
+        self.count = len(rows)
 
 class SegmentCrawler():
-    def __init__(self, cookie_file):
+    # Fetches leaderboard pages through a fetcher, any object with a
+    # fetch(url) method returning the page body. By default this is a pooled
+    # HttpClient with the cookie file loaded once, but tests can swap in one
+    # that talks to a local server or reads saved pages.
+    def __init__(self, cookie_file, fetcher=None, base_url=STRAVA_URL, max_workers=4):
         self.cookie_file = cookie_file
-
-    def crawl(self, segment_id, option, parser_factory):
+        self.base_url = base_url
+        self.max_workers = max_workers
+        if fetcher is None:
+            # Imported here so --server doesn't pay for loading requests.
+            from httpclient import HttpClient
+            fetcher = HttpClient(cookie_file=cookie_file, pool_size=max_workers)
+        self.fetcher = fetcher
+
+    def crawl(self, segment_id, option, parser_factory, stop=None):
+        # Feeds every page of a leaderboard to a new parser from parser_factory.
+        # If stop is given it is called after each page, and returning True ends
+        # the crawl early.
         page_number = 1
         while True:
-            segment_url = "https://www.strava.com/segments/{}?partial=true&{}&page={}&per_page=100".format(segment_id, option, page_number)
+            segment_url = "{}/segments/{}?partial=true&{}&page={}&per_page=100".format(self.base_url, segment_id, option, page_number)
             print("Processing URL: " + segment_url)
 
-            completed = subprocess.run(["curl", "--cookie", self.cookie_file, segment_url], capture_output=True)
             parser = parser_factory.new()
-            parser.feed(completed.stdout.decode("utf-8"))
+            with metrics.timer("fetch_page"):
+                page = self.fetcher.fetch(segment_url)
+            metrics.count("pages_fetched")
+            with metrics.timer("parse_page"):
+                parser.feed(page)
 
             # Processed everything
             if (parser.count < 100): break
+            if stop is not None and stop():
+                metrics.count("crawls_stopped_early")
+                break
 
             page_number = page_number + 1
 
-class SegmentRankingsGatherer:
-    class TimeMapSegmentHTMLParserFactory():
-        def __init__(self,  config, time_map):
-            self.time_map = time_map
+    def crawl_many(self, jobs):
+        # Crawls a list of (segment_id, option, parser_factory) or
+        # (segment_id, option, parser_factory, stop) jobs, up to max_workers of
+        # them at a time. Pages within one leaderboard are still
+        # fetched in order since we only know we are done when a page is short.
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(lambda job: self.crawl(*job), jobs))
+
+class LeaderboardSnapshot():
+    # The parsed results of every leaderboard crawled during one invocation,
+    # keyed by (segment, option). Each distinct leaderboard is only fetched
+    # once no matter how many runs or tools ask for it.
+    #
+    # With a SnapshotStore the results also persist between invocations.
+    # Leaderboards stored less than max_age_seconds ago are used without
+    # fetching anything, and older ones are refetched in full. Every page is
+    # fetched since a faster effort deep in the leaderboard only reshuffles the
+    # pages after it, so stopping at the first unchanged page could miss it.
+    # Pages are compared with the stored ones by their rows, which tells which
+    # leaderboards changed. That is only reported, the standings are always
+    # worked out again from every leaderboard since that is cheap next to
+    # crawling.
+    class FingerprintingPageParserFactory():
+        def __init__(self, config, pages):
             self.config = config
+            self.pages = pages
 
         def new(self):
-            return TimeMapSegmentHTMLParser(self.time_map, self.config)
+            return FingerprintingPageParser(self.config, self.pages)
 
+    def __init__(self, crawler, config=None, store=None, max_age_seconds=0):
+        self.crawler = crawler
+        self.config = config
+        self.store = store
+        self.max_age_seconds = max_age_seconds
+        self.results = {}
+
+        # Leaderboards whose rows differ from what was stored.
+        self.changed = set()
+
+    def _stored_pages(self, segment, option):
+        if self.store is None:
+            return []
+        return self.store.get_pages(segment, option)
+
+    def _is_fresh(self, segment, option):
+        if self.store is None or self.max_age_seconds <= 0:
+            return False
+        fetched = self.store.fetched_at(segment, option)
+        return fetched is not None and time.time() - fetched < self.max_age_seconds
+
+    def fetch(self, keys):
+        missing = []
+        for key in keys:
+            if key not in self.results and key not in missing:
+                missing.append(key)
+
+        stale = []
+        stored = {}
+        for (segment, option) in missing:
+            stored[(segment, option)] = self._stored_pages(segment, option)
+            if self._is_fresh(segment, option):
+                metrics.count("leaderboards_from_store")
+                self.results[(segment, option)] = [row for (_, rows) in stored[(segment, option)] for row in rows]
+            else:
+                stale.append((segment, option))
+
+        fetched = {key: [] for key in stale}
+        metrics.count("leaderboards_crawled", len(stale))
+        self.crawler.crawl_many(
+            [(segment, option, self.FingerprintingPageParserFactory(self.config, fetched[(segment, option)]))
+             for (segment, option) in stale])
+
+        unchanged_pages = 0
+        total_pages = 0
+        for key in stale:
+            pages = fetched[key]
+            if [fingerprint for (fingerprint, _) in pages] != [fingerprint for (fingerprint, _) in stored[key]]:
+                self.changed.add(key)
+            unchanged_pages = unchanged_pages + sum(1 for (page, stored_page) in zip(pages, stored[key]) if page[0] == stored_page[0])
+            total_pages = total_pages + len(pages)
+            if self.store is not None:
+                self.store.put_pages(key[0], key[1], pages)
+            self.results[key] = [row for (_, rows) in pages for row in rows]
+
+        metrics.count("pages_unchanged", unchanged_pages)
+        if self.store is not None and len(missing) > 0:
+            print("Used {} stored leaderboards, refetched {} of which {} changed ({} of {} pages unchanged)".format(
+                len(missing) - len(stale), len(stale), len(self.changed.intersection(stale)), unchanged_pages, total_pages))
+
+    def get(self, segment, option):
+        # The (athlete, seconds) rows of a leaderboard in page order.
+        return self.results[(segment, option)]
+
+class SegmentRankingsGatherer:
     def __init__(self,  segment, config, run_config):
          self.segment = segment
          self.config = config
          self.run_config = run_config
 
-    def _get_time_map(self):
-        time_map = {}
+    def snapshot_keys(self):
+        return [(self.segment, option) for option in self.run_config.options]
 
-        parser_factory = self.TimeMapSegmentHTMLParserFactory(self.config, time_map)
-        crawler = SegmentCrawler(self.config.cookie_file)
+    def _get_time_map(self, snapshot):
+        time_map = {}
         for option in self.run_config.options:
-            crawler.crawl(self.segment, option, parser_factory)
+            for (person, seconds) in snapshot.get(self.segment, option):
+                time_map[person] = seconds
 
         return time_map
 
-    def run(self):
-        time_map = self._get_time_map()
+    def process(self, snapshot):
+        time_map = self._get_time_map(snapshot)
 
         rankings = [(k, v) for k, v in time_map.items()]
         rankings.sort(key=(lambda a : a[1]))
 
         self.process_rankings(rankings)
 
+    def run(self, snapshot=None):
+        if snapshot is None:
+            snapshot = LeaderboardSnapshot(SegmentCrawler(self.config.cookie_file), self.config)
+        snapshot.fetch(self.snapshot_keys())
+        self.process(snapshot)
+
+def run_gatherers(gatherers, snapshot):
+    # Fetches the leaderboards for all the gatherers concurrently, then processes
+    # the rankings one at a time in order since they usually share state.
+    keys = []
+    for gatherer in gatherers:
+        keys = keys + gatherer.snapshot_keys()
+    snapshot.fetch(keys)
+    for gatherer in gatherers:
+        gatherer.process(snapshot)
+
 class SegmentStatisticsAggregator(SegmentRankingsGatherer):
     def __init__(self,  segment, collected_data, config, run_config):
          super().__init__(segment, config, run_config)
@@ -178,7 +398,38 @@ class Config():
             self.run_configs.append(self.RunConfig(run))
 
 
-def main():
+def write_standings(config, snapshot, output_dir):
+    # Fetches every leaderboard the runs need and writes each run's standings.
+    # Returns the files written.
+
+    # Fetch everything every run needs up front, so leaderboards shared between
+    # runs are only crawled once and all of them are crawled concurrently.
+    with metrics.timer("crawl"):
+        snapshot.fetch([(segment, option) for run_config in config.run_configs
+                        for option in run_config.options for segment in config.segments])
+
+    output_files = []
+    for run_config in config.run_configs:
+        collected_data = CollectedData._make([{}, {}])
+        aggregators = [SegmentStatisticsAggregator(segment, collected_data, config, run_config)
+                       for segment in config.segments]
+        with metrics.timer("aggregate"):
+            run_gatherers(aggregators, snapshot)
+
+        finalrankings = [(k, v) for k, v in collected_data.rankings.items()]
+        finalrankings.sort(reverse=True, key=(lambda a : a[1]))
+        output_file = os.path.join(output_dir, run_config.output_file)
+        with open(output_file, 'w') as file:
+            for person, points in finalrankings:
+                file.write(person + "," + str(points) + "," + str(collected_data.segment_count[person]) + "\n")
+        output_files.append(output_file)
+    return output_files
+
+def load_config(config_file, cookie_file):
+    with open(config_file, "r") as file:
+        return Config(json.loads(file.read()), cookie_file)
+
+def build_parser():
     parser = argparse.ArgumentParser(
         description="Automatically creates a segment leaderboard"
     )
@@ -186,25 +437,33 @@ def main():
     parser.add_argument("--config_file", type=str, required=True)
     parser.add_argument("--cookie_file", type=str, required=True)
     parser.add_argument("--output_dir", type=str, required=True)
-    args = parser.parse_args()
+    parser.add_argument("--concurrency", type=int, required=False, default=4,
+                        help="The number of leaderboards to crawl at once")
+    parser.add_argument("--snapshot_file", type=str, required=False, default=None,
+                        help="If set, crawled leaderboards are stored in this file and reused by later runs")
+    parser.add_argument("--max_snapshot_age_minutes", type=float, required=False, default=0,
+                        help=("""Leaderboards in the snapshot file younger than this are used
+                                 without fetching them again. The default of 0 always refetches"""))
+    metrics.add_argument(parser)
+    jobclient.add_argument(parser)
+    return parser
 
-    config_file = open(args.config_file, "r")
-    config_file_contents = config_file.read()
-    json_config = json.loads(config_file_contents)
-    cookie_file = args.cookie_file
-    config = Config(json_config, cookie_file)
+def main():
+    args = build_parser().parse_args()
 
-    for run_config in config.run_configs:
-        collected_data = CollectedData._make([{}, {}])
-        for segment in config.segments:
-            aggregator = SegmentStatisticsAggregator(segment, collected_data, config, run_config)
-            aggregator.run()
+    if args.server is not None:
+        result = jobclient.submit(args.server, "leaderboard", args,
+                                  ["config_file", "cookie_file", "output_dir", "snapshot_file"])
+        for output_file in result["output_files"]:
+            print("Wrote " + output_file)
+        return
 
-        finalrankings = [(k, v) for k, v in collected_data.rankings.items()]
-        finalrankings.sort(reverse=True, key=(lambda a : a[1]))
-        with open(os.path.join(args.output_dir, run_config.output_file), 'w') as file:
-            for person, points in finalrankings:
-                file.write(person + "," + str(points) + "," + str(collected_data.segment_count[person]) + "\n")
+    config = load_config(args.config_file, args.cookie_file)
+    store = SnapshotStore(args.snapshot_file) if args.snapshot_file is not None else None
+    snapshot = LeaderboardSnapshot(SegmentCrawler(args.cookie_file, max_workers=args.concurrency), config,
+                                   store, args.max_snapshot_age_minutes * 60)
+    write_standings(config, snapshot, args.output_dir)
+    metrics.report(args.metrics)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,103 @@
+# Local persistent cache for Google Maps lookups. Segment start and end points
+# don't move, so distances between them, and the directions for the legs of a
+# route, can be reused across runs instead of paying for a network round trip
+# and API quota every time.
+
+import sqlite3
+import threading
+import time
+
+DEFAULT_TTL_SECONDS = 30 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 100000
+
+class MapsCache():
+    def __init__(self, filename, precision=5, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        self.precision = precision
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS distances (
+                   origin TEXT, destination TEXT, mode TEXT, meters REAL, created REAL,
+                   PRIMARY KEY (origin, destination, mode))""")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS distances_created ON distances (created)")
+
+        # Directions are kept as the encoded overview polyline Google returns.
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS directions (
+                   origin TEXT, destination TEXT, mode TEXT, polyline TEXT, created REAL,
+                   PRIMARY KEY (origin, destination, mode))""")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS directions_created ON directions (created)")
+        self.connection.commit()
+
+    def key(self, latlng):
+        # Points are rounded so that the same location coming from a polyline or
+        # from the command line maps to the same entry. Five digits is about a meter.
+        return "{:.{p}f},{:.{p}f}".format(float(latlng["lat"]), float(latlng["lng"]),
+                                          p=self.precision)
+
+    def get_distances(self, pairs, mode):
+        # Returns a map of (origin key, destination key) -> meters for every pair
+        # that has a fresh entry. Missing and expired pairs are left out.
+        oldest = time.time() - self.ttl_seconds
+        found = {}
+        with self.lock:
+            for (origin, destination) in pairs:
+                row = self.connection.execute(
+                    "SELECT meters FROM distances WHERE origin=? AND destination=? AND mode=? AND created>=?",
+                    (origin, destination, mode, oldest)).fetchone()
+                if row is not None:
+                    found[(origin, destination)] = row[0]
+        return found
+
+    def put_distances(self, distances, mode):
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO distances VALUES (?, ?, ?, ?, ?)",
+                [(origin, destination, mode, meters, now)
+                 for ((origin, destination), meters) in distances.items()])
+            self._evict("distances")
+            self.connection.commit()
+
+    def get_directions(self, pairs, mode):
+        # Returns a map of (origin key, destination key) -> encoded polyline for
+        # every pair that has a fresh entry.
+        oldest = time.time() - self.ttl_seconds
+        found = {}
+        with self.lock:
+            for (origin, destination) in pairs:
+                row = self.connection.execute(
+                    "SELECT polyline FROM directions WHERE origin=? AND destination=? AND mode=? AND created>=?",
+                    (origin, destination, mode, oldest)).fetchone()
+                if row is not None:
+                    found[(origin, destination)] = row[0]
+        return found
+
+    def put_directions(self, polylines, mode):
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO directions VALUES (?, ?, ?, ?, ?)",
+                [(origin, destination, mode, polyline, now)
+                 for ((origin, destination), polyline) in polylines.items()])
+            self._evict("directions")
+            self.connection.commit()
+
+    def _evict(self, table):
+        self.connection.execute("DELETE FROM {} WHERE created<?".format(table),
+                                (time.time() - self.ttl_seconds,))
+        (count,) = self.connection.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()
+        if count > self.max_entries:
+            # Drop the oldest entries first.
+            self.connection.execute(
+                """DELETE FROM {0} WHERE rowid IN (
+                       SELECT rowid FROM {0} ORDER BY created LIMIT ?)""".format(table),
+                (count - self.max_entries,))
+
+    def close(self):
+        self.connection.close()
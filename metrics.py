@@ -0,0 +1,78 @@
+# Per-stage timers and counters shared by all the tools. Anything can record
+# into the process wide registry through timer() and count(), and a tool's
+# --metrics flag prints a summary of where the time went when it exits.
+#
+# Timers running on several threads at once each add their own time, so a
+# stage's seconds can be more than the wall clock time of the run.
+
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+class Metrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            (calls, total) = self.timers.get(name, (0, 0.0))
+            self.timers[name] = (calls + 1, total + seconds)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "timers": {name: {"calls": calls, "seconds": round(seconds, 6)}
+                           for (name, (calls, seconds)) in sorted(self.timers.items())},
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def table(self):
+        data = self.to_dict()
+        width = max([len(name) for name in list(data["timers"]) + list(data["counters"])] + [7])
+        lines = ["{:<{w}} {:>8} {:>12}".format("stage", "calls", "seconds", w=width)]
+        for (name, timer) in data["timers"].items():
+            lines.append("{:<{w}} {:>8} {:>12.3f}".format(name, timer["calls"], timer["seconds"], w=width))
+        lines.append("")
+        lines.append("{:<{w}} {:>8}".format("counter", "value", w=width))
+        for (name, value) in data["counters"].items():
+            lines.append("{:<{w}} {:>8}".format(name, value, w=width))
+        return "\n".join(lines)
+
+    def report(self, output_format, file=sys.stderr):
+        # Goes to stderr by default so it doesn't mix with output tools print.
+        if output_format == "json":
+            print(json.dumps(self.to_dict(), indent=2), file=file)
+        elif output_format == "table":
+            print(self.table(), file=file)
+
+metrics = Metrics()
+
+def timer(name):
+    return metrics.timer(name)
+
+def count(name, amount=1):
+    metrics.count(name, amount)
+
+def add_argument(parser):
+    parser.add_argument("--metrics", type=str, required=False, default=None, choices=["table", "json"],
+                        help="If set, prints the time spent in each stage and counters like API calls made on exit")
+
+def report(output_format):
+    if output_format is not None:
+        metrics.report(output_format)
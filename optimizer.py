@@ -0,0 +1,161 @@
+# Anytime local search for the segment ordering. Starts from the nearest
+# neighbor tour over the distance matrix and improves it with 2-opt and Or-opt
+# moves until no move helps or the time budget runs out, returning the best tour
+# found so far. The matrix is asymmetric (it runs from the end of one segment to
+# the start of the next), so 2-opt accounts for the cost of running the reversed
+# stretch backwards using prefix sums, which keeps every move evaluation O(1).
+# Once the tour is locally optimal any time left in the budget goes to
+# perturbing the best tour with a random double bridge and searching again.
+
+import random
+import time
+
+import numpy as np
+
+import metrics
+
+def nearest_neighbor_tour(dists):
+    # The same nearest neighbor greedy the route builder uses, but on the matrix.
+    n = len(dists)
+    path = [0]
+    remaining = set(range(1, n))
+    while len(remaining) > 0:
+        last = path[len(path) - 1]
+        closest = min(remaining, key=lambda k: (dists[last][k], k))
+        path.append(closest)
+        remaining.remove(closest)
+    return path
+
+def tour_cost(dists, path):
+    return sum(dists[path[i]][path[(i + 1) % len(path)]] for i in range(len(path)))
+
+def neighbor_lists(dists, size):
+    # For every node, the nodes with the cheapest edges into it and out of it.
+    incoming = np.argsort(dists, axis=0, kind="stable")
+    outgoing = np.argsort(dists, axis=1, kind="stable")
+    neighbors_in = []
+    neighbors_out = []
+    for k in range(len(dists)):
+        neighbors_in.append([int(a) for a in incoming[:, k] if a != k][:size])
+        neighbors_out.append([int(a) for a in outgoing[k] if a != k][:size])
+    return (neighbors_in, neighbors_out)
+
+class TourOptimizer():
+    def __init__(self, dists, neighbors=10, max_chain_length=3):
+        self.dists = np.asarray(dists, dtype=np.float64)
+        self.n = len(dists)
+        self.max_chain_length = max_chain_length
+        (self.neighbors_in, self.neighbors_out) = neighbor_lists(self.dists, neighbors)
+        self.passes = 0
+        self.moves = 0
+        self.restarts = 0
+
+    def _set_tour(self, path):
+        # The tour is kept with the start repeated at the end so that every edge
+        # is tour[i] -> tour[i + 1].
+        self.tour = list(path) + [0]
+        self._update()
+
+    def _update(self):
+        tour = np.array(self.tour)
+        self.position = np.empty(self.n, dtype=np.int64)
+        self.position[tour[:self.n]] = np.arange(self.n)
+
+        # forward[i] is the cost of tour[0] -> ... -> tour[i], backward[i] the
+        # cost of travelling the same stretch in the other direction.
+        self.forward = np.concatenate(([0.0], np.cumsum(self.dists[tour[:-1], tour[1:]])))
+        self.backward = np.concatenate(([0.0], np.cumsum(self.dists[tour[1:], tour[:-1]])))
+
+    def _two_opt(self):
+        # Reverse tour[i..j]. Only tries j where the new edge tour[i - 1] -> tour[j]
+        # goes to one of tour[i - 1]'s cheap neighbors.
+        d = self.dists
+        tour = self.tour
+        for i in range(1, self.n - 1):
+            a = tour[i - 1]
+            b = tour[i]
+            for c in self.neighbors_out[a]:
+                j = int(self.position[c])
+                if j <= i: continue
+                e = tour[j + 1]
+                delta = (d[a][c] + d[b][e] - d[a][b] - d[c][e]
+                         + (self.backward[j] - self.backward[i]) - (self.forward[j] - self.forward[i]))
+                if delta < -1e-9:
+                    tour[i:j + 1] = reversed(tour[i:j + 1])
+                    self._update()
+                    return True
+        return False
+
+    def _or_opt(self):
+        # Move a chain of up to max_chain_length nodes, without reversing it, to
+        # sit after a node that has a cheap edge into the chain's first node.
+        d = self.dists
+        tour = self.tour
+        for length in range(1, self.max_chain_length + 1):
+            for i in range(1, self.n - length + 1):
+                first = tour[i]
+                last = tour[i + length - 1]
+                p = tour[i - 1]
+                q = tour[i + length]
+                removal_gain = d[p][first] + d[last][q] - d[p][q]
+                for a in self.neighbors_in[first]:
+                    k = int(self.position[a])
+                    if i - 1 <= k <= i + length - 1: continue
+                    b = tour[k + 1]
+                    delta = d[a][first] + d[last][b] - d[a][b] - removal_gain
+                    if delta < -1e-9:
+                        chain = tour[i:i + length]
+                        del tour[i:i + length]
+                        insert_at = k + 1 if k < i else k + 1 - length
+                        tour[insert_at:insert_at] = chain
+                        self._update()
+                        return True
+        return False
+
+    def _local_search(self, deadline):
+        while time.monotonic() < deadline:
+            self.passes = self.passes + 1
+            if self._two_opt() or self._or_opt():
+                self.moves = self.moves + 1
+                continue
+            return True
+        return False
+
+    def _double_bridge(self, path, rng):
+        # Cuts the tour into four stretches and reconnects them as A C B D, a
+        # change 2-opt and Or-opt can't easily undo and which reverses nothing.
+        (i, j, k) = sorted(rng.sample(range(1, self.n), 3))
+        return path[:i] + path[j:k] + path[i:j] + path[k:]
+
+    def optimize(self, path, time_budget_seconds, seed=1):
+        # Returns the improved path, starting at 0 like held_karp's.
+        if self.n <= 2:
+            return list(path)
+        if self.n == 3:
+            # Too small for the moves below, but the two directions around an
+            # asymmetric matrix can cost very different amounts.
+            return min([[0, 1, 2], [0, 2, 1]], key=lambda x: tour_cost(self.dists, x))
+        deadline = time.monotonic() + time_budget_seconds
+        rng = random.Random(seed)
+
+        self._set_tour(path)
+        self._local_search(deadline)
+        best = self.tour[:self.n]
+        best_cost = self.forward[self.n]
+        while self.n >= 8 and time.monotonic() < deadline:
+            self.restarts = self.restarts + 1
+            self._set_tour(self._double_bridge(best, rng))
+            self._local_search(deadline)
+            if self.forward[self.n] < best_cost - 1e-9:
+                best = self.tour[:self.n]
+                best_cost = self.forward[self.n]
+        return best
+
+def optimize_tour(dists, time_budget_seconds, neighbors=10):
+    # Nearest neighbor seed improved by local search within the time budget.
+    optimizer = TourOptimizer(dists, neighbors)
+    path = optimizer.optimize(nearest_neighbor_tour(dists), time_budget_seconds)
+    metrics.count("optimizer_passes", optimizer.passes)
+    metrics.count("optimizer_moves", optimizer.moves)
+    metrics.count("optimizer_restarts", optimizer.restarts)
+    return path
@@ -0,0 +1,242 @@
+# Offline bicycle routing over an OpenStreetMap extract, as a stand-in for the
+# Google Maps client. The road graph is held in compressed sparse row form:
+# node coordinates in two float64 arrays, and for node i its outgoing edges are
+# targets[offsets[i]:offsets[i + 1]] with lengths in meters alongside. Points are
+# snapped to the nearest routable node with a grid index, and a distance matrix
+# row is a single Dijkstra search from its origin that stops once every
+# destination is settled, so an N x N matrix costs N searches in process.
+#
+# OsmRouter has the distance_matrix and directions methods of googlemaps.Client
+# that DistanceMatrixBuilder and DirectionsFetcher use, so either can be plugged
+# in. Parsing a .osm file is slow, so the graph is also saved next to it as a
+# .npz file and loaded from there while it is newer than the extract.
+
+import heapq
+import os
+import xml.etree.ElementTree as ElementTree
+
+import googlemaps
+import numpy as np
+from haversine import Unit
+
+import metrics
+from geometry import haversine_distances
+from spatialindex import GridIndex
+
+# Roads a bike can't use, whatever their other tags say.
+EXCLUDED_HIGHWAYS = {"motorway", "motorway_link", "construction", "proposed", "abandoned",
+                     "platform", "raceway", "bus_guideway", "escape", "elevator", "steps"}
+
+def is_cyclable(tags):
+    highway = tags.get("highway")
+    if highway is None or highway in EXCLUDED_HIGHWAYS:
+        return False
+    if tags.get("bicycle") == "no" or tags.get("access") in ("no", "private"):
+        return tags.get("bicycle") in ("yes", "designated", "permissive")
+    if highway in ("footway", "pedestrian", "bridleway"):
+        return tags.get("bicycle") in ("yes", "designated", "permissive")
+    return True
+
+def oneway_direction(tags):
+    # 1 if the way can only be ridden in the order of its nodes, -1 if only in
+    # reverse and 0 if both ways.
+    if tags.get("oneway:bicycle") == "no" or tags.get("cycleway", "").startswith("opposite"):
+        return 0
+    oneway = tags.get("oneway")
+    if oneway in ("yes", "true", "1") or tags.get("junction") == "roundabout":
+        return 1
+    if oneway == "-1":
+        return -1
+    return 0
+
+def parse_osm(filename):
+    # Returns (node ids, lats, lngs, edge sources, edge targets) for the cyclable
+    # ways of an OSM XML extract, with edges as indices into the node arrays.
+    coordinates = {}
+    ways = []
+    for (event, element) in ElementTree.iterparse(filename, events=("end",)):
+        if element.tag == "node":
+            coordinates[element.get("id")] = (float(element.get("lat")), float(element.get("lon")))
+            element.clear()
+        elif element.tag == "way":
+            tags = {tag.get("k"): tag.get("v") for tag in element.iter("tag")}
+            if is_cyclable(tags):
+                ways.append(([nd.get("ref") for nd in element.iter("nd")], oneway_direction(tags)))
+            element.clear()
+
+    index = {}
+    sources = []
+    targets = []
+    for (refs, direction) in ways:
+        refs = [ref for ref in refs if ref in coordinates]
+        for ref in refs:
+            if ref not in index:
+                index[ref] = len(index)
+        for (a, b) in zip(refs[:-1], refs[1:]):
+            if direction >= 0:
+                sources.append(index[a])
+                targets.append(index[b])
+            if direction <= 0:
+                sources.append(index[b])
+                targets.append(index[a])
+
+    node_ids = list(index)
+    lats = np.array([coordinates[x][0] for x in node_ids], dtype=np.float64)
+    lngs = np.array([coordinates[x][1] for x in node_ids], dtype=np.float64)
+    return (node_ids, lats, lngs, np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64))
+
+class OsmGraph():
+    def __init__(self, lats, lngs, offsets, targets, lengths):
+        self.lats = lats
+        self.lngs = lngs
+        self.offsets = offsets
+        self.targets = targets
+        self.lengths = lengths
+
+        # Dijkstra walks the edges one at a time, which is much faster on Python
+        # lists than on numpy arrays.
+        self.offset_list = offsets.tolist()
+        self.target_list = targets.tolist()
+        self.length_list = lengths.tolist()
+
+        # Only snap to the largest connected part of the network, so a point
+        # never lands on an isolated bit of path that goes nowhere.
+        routable = self._largest_component()
+        if not np.any(routable):
+            raise Exception("There are no roads a bike can use in the OSM extract")
+        self.routable = np.flatnonzero(routable)
+        self.index = GridIndex(lats[self.routable], lngs[self.routable])
+
+    @classmethod
+    def from_edges(cls, lats, lngs, sources, targets):
+        order = np.argsort(sources, kind="stable")
+        (sources, targets) = (sources[order], targets[order])
+        offsets = np.zeros(len(lats) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(lats)), out=offsets[1:])
+        lengths = haversine_distances(lats[sources], lngs[sources], lats[targets], lngs[targets], Unit.METERS)
+        return cls(lats, lngs, offsets, targets, lengths)
+
+    @classmethod
+    def load(cls, filename):
+        # Takes an .osm extract or a graph saved with save().
+        if filename.endswith(".npz"):
+            data = np.load(filename)
+            return cls(data["lats"], data["lngs"], data["offsets"], data["targets"], data["lengths"])
+        compiled = filename + ".npz"
+        if os.path.exists(compiled) and os.path.getmtime(compiled) >= os.path.getmtime(filename):
+            return cls.load(compiled)
+        (_, lats, lngs, sources, targets) = parse_osm(filename)
+        graph = cls.from_edges(lats, lngs, sources, targets)
+        graph.save(compiled)
+        return graph
+
+    def save(self, filename):
+        with open(filename, "wb") as file:
+            np.savez(file, lats=self.lats, lngs=self.lngs, offsets=self.offsets,
+                     targets=self.targets, lengths=self.lengths)
+
+    def __len__(self):
+        return len(self.lats)
+
+    def _largest_component(self):
+        # Connected components ignoring edge direction.
+        neighbors = [[] for i in range(len(self))]
+        for node in range(len(self)):
+            for edge in range(self.offset_list[node], self.offset_list[node + 1]):
+                neighbors[node].append(self.target_list[edge])
+                neighbors[self.target_list[edge]].append(node)
+        component = [-1] * len(self)
+        sizes = []
+        for node in range(len(self)):
+            if component[node] >= 0: continue
+            component[node] = len(sizes)
+            stack = [node]
+            size = 0
+            while len(stack) > 0:
+                current = stack.pop()
+                size = size + 1
+                for neighbor in neighbors[current]:
+                    if component[neighbor] < 0:
+                        component[neighbor] = len(sizes)
+                        stack.append(neighbor)
+            sizes.append(size)
+        if len(sizes) == 0:
+            return np.zeros(0, dtype=bool)
+        return np.array(component) == int(np.argmax(sizes))
+
+    def snap(self, latlng):
+        # Returns (node, meters from latlng to it).
+        (i, meters) = self.index.nearest(latlng, 1, Unit.METERS)[0]
+        return (int(self.routable[i]), meters)
+
+    def shortest_paths(self, source, targets):
+        # Dijkstra from source, stopping once every target is settled. Returns
+        # maps of node -> distance and node -> the node before it.
+        metrics.count("osm_searches")
+        remaining = set(targets)
+        distances = {source: 0.0}
+        previous = {source: None}
+        settled = set()
+        heap = [(0.0, source)]
+        while len(heap) > 0 and len(remaining) > 0:
+            (distance, node) = heapq.heappop(heap)
+            if node in settled: continue
+            settled.add(node)
+            remaining.discard(node)
+            for edge in range(self.offset_list[node], self.offset_list[node + 1]):
+                target = self.target_list[edge]
+                candidate = distance + self.length_list[edge]
+                if candidate < distances.get(target, float("inf")):
+                    distances[target] = candidate
+                    previous[target] = node
+                    heapq.heappush(heap, (candidate, target))
+        return ({node: distances[node] for node in settled}, previous)
+
+class OsmRouter():
+    # Answers the googlemaps.Client calls routebuilder makes from an OsmGraph.
+    # Every request takes a single origin and any number of destinations, which
+    # DistanceMatrixBuilder reads from request_limits.
+    request_limits = (1, None, None)
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def _latlng(self, latlng):
+        if isinstance(latlng, dict):
+            return {"lat": float(latlng["lat"]), "lng": float(latlng["lng"])}
+        return {"lat": float(latlng[0]), "lng": float(latlng[1])}
+
+    def distance_matrix(self, origins, destinations, mode=None, units=None):
+        # Distances include the straight line from each point to the node it
+        # snapped to.
+        destination_snaps = [self.graph.snap(self._latlng(x)) for x in destinations]
+        rows = []
+        for origin in origins:
+            (source, source_meters) = self.graph.snap(self._latlng(origin))
+            (distances, _) = self.graph.shortest_paths(source, [node for (node, _) in destination_snaps])
+            elements = []
+            for (node, meters) in destination_snaps:
+                if node not in distances:
+                    elements.append({"status": "ZERO_RESULTS"})
+                    continue
+                total = int(round(source_meters + distances[node] + meters))
+                elements.append({"status": "OK", "distance": {"value": total}})
+            rows.append({"elements": elements})
+        return {"status": "OK", "rows": rows}
+
+    def directions(self, origin, destination, mode=None):
+        (source, _) = self.graph.snap(self._latlng(origin))
+        (target, _) = self.graph.snap(self._latlng(destination))
+        (distances, previous) = self.graph.shortest_paths(source, [target])
+        if target not in distances:
+            return []
+        path = []
+        node = target
+        while node is not None:
+            path.append(node)
+            node = previous[node]
+        path.reverse()
+        latlngs = [self._latlng(origin)] + \
+                  [{"lat": float(self.graph.lats[x]), "lng": float(self.graph.lngs[x])} for x in path] + \
+                  [self._latlng(destination)]
+        return [{"overview_polyline": {"points": googlemaps.convert.encode_polyline(latlngs)}}]
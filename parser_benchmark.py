@@ -0,0 +1,70 @@
+#!/usr/bin/env python3.8
+
+# Compares the row extractor against the HTMLParser based leaderboard parser
+# on 100 row partial leaderboard pages, in rows parsed per second.
+
+import argparse
+import random
+import time
+
+import fakes
+import leaderboard
+
+def synthetic_page(seed):
+    rng = random.Random(seed)
+    rows = sorted([("Rider {}".format(i), rng.randint(60, 4 * 3600)) for i in range(100)],
+                  key=lambda a : a[1])
+    return fakes.leaderboard_page(rows)
+
+def parse_with_html_parser(page):
+    rows = []
+    leaderboard.ResultsSegmentHTMLParser(rows, None).feed(page)
+    return rows
+
+def parse_with_extractor(page):
+    return leaderboard.LeaderboardRowExtractor().feed(page)
+
+def rows_per_second(parse, pages, repeat):
+    rows = 0
+    start = time.perf_counter()
+    for i in range(repeat):
+        for page in pages:
+            rows = rows + len(parse(page))
+    return rows / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks leaderboard page parsing"
+    )
+
+    parser.add_argument("--page_file", type=str, action="append", default=[],
+                        help="A saved leaderboard page to parse. Can be repeated. Defaults to generated pages")
+    parser.add_argument("--pages", type=int, required=False, default=20,
+                        help="The number of generated pages to use when no page file is given")
+    parser.add_argument("--repeat", type=int, required=False, default=10)
+    args = parser.parse_args()
+
+    pages = []
+    for page_file in args.page_file:
+        with open(page_file, "r") as file:
+            pages.append(file.read())
+    if len(pages) == 0:
+        pages = [synthetic_page(seed) for seed in range(args.pages)]
+
+    # Both parsers have to agree before their speed means anything.
+    for page in pages:
+        if parse_with_html_parser(page) != parse_with_extractor(page):
+            raise Exception("Parsers disagree on a page")
+
+    # The bytes the network hands us, as the crawler would see them.
+    encoded_pages = [page.encode("utf-8") for page in pages]
+
+    html_parser_rate = rows_per_second(parse_with_html_parser, pages, args.repeat)
+    extractor_rate = rows_per_second(parse_with_extractor, encoded_pages, args.repeat)
+    print("parser,rows_per_second")
+    print("SegmentHTMLParser,{:.0f}".format(html_parser_rate))
+    print("LeaderboardRowExtractor,{:.0f}".format(extractor_rate))
+    print("speedup,{:.1f}x".format(extractor_rate / html_parser_rate))
+
+if __name__ == "__main__":
+    main()
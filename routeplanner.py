@@ -0,0 +1,357 @@
+# Builds a GPX route through a set of Strava segments. routebuilder.py is the
+# command line tool around this, kept apart so that sending a route to the route
+# server with --server doesn't have to load googlemaps, numpy and the rest first.
+
+import gzip
+import itertools
+import time
+
+import googlemaps
+import branchbound
+import cluster
+import heldkarp
+import metrics
+import optimizer
+from directions import DirectionsFetcher
+from distancematrix import DistanceMatrixBuilder
+from mapscache import MapsCache
+from osmrouting import OsmGraph, OsmRouter
+from segmentstore import SegmentLoader
+from haversine import Unit
+import numpy as np
+from geometry import Route
+from spatialindex import GridIndex
+
+SEGMENT_JSON_DIRECTORY = "segment_information"
+
+def compute_distance_in_miles(latlons):
+    return Route.from_latlngs(latlons).length(Unit.MILES)
+
+def format_gpx_times(times):
+    # Formats unix timestamps in bulk as GPX UTC times, truncated to the second.
+    return np.datetime_as_string(np.floor(times).astype(np.int64).astype("datetime64[s]"))
+
+def open_gpx(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, 'wt', encoding="utf-8")
+    return open(filename, 'w')
+
+def write_gpx(latlons, filename, overall_distance=None, chunk_size=4096):
+    # latlons can be any iterable of points. It is consumed chunk_size points at
+    # a time, so when the caller knows the route length in miles and passes it
+    # as overall_distance, the points are never copied into one list and the
+    # file is never built up as one string.
+    if overall_distance is None:
+        latlons = list(latlons)
+        overall_distance = compute_distance_in_miles(latlons)
+
+    # We move at 1mph, so set the start time to back far enough so the ride doesn't
+    # end in the future. Note that we attempt to make this look like a real ride
+    # because otherwise Strava rejects the GPX file. Unfortunately the only way
+    # to create a route on Strava is to upload it as a ride first and then make
+    # a route from that, so we have to do this.
+    current_time = time.time() - overall_distance * 3600 * 2
+    current_datetime_string = format_gpx_times(np.array([current_time]))[0]
+
+    with open_gpx(filename) as file:
+        file.write(r'<?xml version="1.0" encoding="UTF-8"?>')
+        file.write('\n')
+        file.write(r'''<gpx xmlns="http://www.topografix.com/GPX/1/1"
+                        xmlns:gpxdata="http://www.cluetrust.com/XML/GPXDATA/1/0"
+                        creator="--No GPS SELECTED--" version="8.1">''')
+        file.write('<metadata><time>{}</time></metadata>'.format(current_datetime_string + "Z"))
+        file.write(r'  <name>Example gpx</name><type>Biking</type>')
+        file.write('\n')
+        file.write(r'  <trk><name>Example gpx</name><number>1</number><trkseg>')
+        file.write('\n')
+
+        points = iter(latlons)
+        prev_latlon = None
+        while True:
+            chunk = list(itertools.islice(points, chunk_size))
+            if len(chunk) == 0: break
+
+            # Move forward at 1mph plus a 1 second slack per point. The first
+            # point of a chunk is measured from the last point of the one before.
+            route = Route.from_latlngs(chunk if prev_latlon is None else [prev_latlon] + chunk)
+            leg_distances = route.leg_distances(Unit.MILES)
+            if prev_latlon is None:
+                leg_distances = np.concatenate(([0.0], leg_distances))
+            times = current_time + np.cumsum(1 + 3600 * leg_distances)
+            current_time = times[len(times) - 1]
+
+            file.write(''.join(
+                '    <trkpt lat="{}" lon="{}"><time>{}Z</time></trkpt>\n'.format(latlon["lat"], latlon["lng"], time_string)
+                for (latlon, time_string) in zip(chunk, format_gpx_times(times))))
+            prev_latlon = chunk[len(chunk) - 1]
+        file.write('  </trkseg></trk>')
+        file.write('\n')
+        file.write('</gpx>')
+
+def get_segments_information(loader, segment_ids):
+  # Returns the ids that could be loaded along with their length and points.
+  # Segments that couldn't be downloaded are reported and left out.
+  (segments, failures) = loader.load(segment_ids, SEGMENT_JSON_DIRECTORY)
+  for (segment_id, error) in failures.items():
+      print("Skipping segment {}: {}".format(segment_id, error))
+
+  loaded_ids = [x for x in segment_ids if x in segments]
+  return (loaded_ids, [{"length": segments[x].length, "latlngs": segments[x].latlngs()} for x in loaded_ids])
+
+def get_segment_distances(matrix_builder, start_latlng, segment_information):
+    # 2N segments. Need to include from start of a segment to end of a segment, but
+    # there is only one path there.
+    start_and_segment_information = [{'length': 1, 'latlngs': [start_latlng, start_latlng]}] + segment_information
+    number_of_points = 1 + len(segment_information)
+
+    # Compute distance of the end of each segment to the start of all the other ones.
+    origins = [x["latlngs"][len(x["latlngs"]) - 1] for x in start_and_segment_information]
+    destinations = [x["latlngs"][0] for x in start_and_segment_information]
+    with metrics.timer("distance_matrix"):
+        matrix = matrix_builder.build(origins, destinations, skip_diagonal=True)
+
+    distances = [[0] * number_of_points for i in range(number_of_points)]
+    for i in range(number_of_points):
+        for j in range(number_of_points):
+            if i == j: continue
+
+            # Go from end to start of next value.
+            distances[i][j] = matrix[i][j] + start_and_segment_information[j]["length"]
+
+    print("Completed constructing distance matrix")
+    return distances
+
+def get_segments_for_path(path, segment_information, indices):
+    # Turns a path over the distance matrix, where 0 is the start, back into segments.
+    result = []
+    for i in path:
+        if i == 0: continue
+        else:
+            indices.append(i-1)
+            result.append(segment_information[i-1]["latlngs"])
+    return result
+
+def get_segment_ordering_heldkarp(matrix_builder, start_latlng, segment_information, max_segments, indices):
+    # With max_segments this picks the max_segments segments that make the
+    # shortest loop, rather than stopping early like the greedy algorithm.
+    distances = get_segment_distances(matrix_builder, start_latlng, segment_information)
+    with metrics.timer("heldkarp"):
+        if max_segments != -1:
+            path = heldkarp.held_karp_best_k(distances, max_segments)
+        else:
+            path = heldkarp.held_karp(distances)
+    return get_segments_for_path(path, segment_information, indices)
+
+def get_segment_ordering_optimizer(matrix_builder, start_latlng, segment_information, time_budget_seconds, indices):
+    # Greedy tour improved by local search for as long as the time budget allows.
+    # Near optimal for far more segments than Held-Karp can handle.
+    distances = get_segment_distances(matrix_builder, start_latlng, segment_information)
+    with metrics.timer("optimizer"):
+        path = optimizer.optimize_tour(distances, time_budget_seconds)
+    return get_segments_for_path(path, segment_information, indices)
+
+def get_segment_ordering_branch_and_bound(matrix_builder, start_latlng, segment_information, max_nodes,
+                                          time_limit_seconds, indices):
+    # Exact like Held-Karp but without its memory use, so it handles 25-40
+    # segments. If it runs out of time the route is still good, and how far from
+    # optimal it could be is printed.
+    distances = get_segment_distances(matrix_builder, start_latlng, segment_information)
+    with metrics.timer("branch_and_bound"):
+        (path, cost, lower_bound) = branchbound.solve(distances, max_nodes, time_limit_seconds)
+    if cost - lower_bound <= 1e-9:
+        print("Found the optimal route")
+    else:
+        print("Stopped early, the route is within {:.2%} of optimal".format((cost - lower_bound) / cost))
+    return get_segments_for_path(path, segment_information, indices)
+
+def get_segment_ordering_clustered(matrix_builder, start_latlng, segment_information, max_cluster_size,
+                                   workers, indices):
+    # Splits the segments into clusters small enough to solve exactly, for
+    # segment lists far too big to look up every distance between.
+    order = cluster.order_segments(matrix_builder, start_latlng, segment_information,
+                                   max_cluster_size, workers)
+    indices.extend(order)
+    return [segment_information[i]["latlngs"] for i in order]
+
+def get_segment_ordering_greedy(matrix_builder, start_latlng, segment_latlngs, max_segments, indices):
+    # This uses the nearest neighbor greedy algorithm for determining
+    # the segment ordering. It starts with the origin, then finds the next
+    # closest segment, and then the next closest, etc. This is not optimal, but
+    # it works if you have a very large number of segments. For a smaller number where
+    # you want an optimal solution, use the heldkarp algorithm above.
+    result = []
+    origin = start_latlng
+    remaining = set(range(0, len(segment_latlngs)))
+    segment_starts = GridIndex.from_latlngs([x[0] for x in segment_latlngs])
+    while (len(remaining) > 0):
+        # The ten segments not visited yet whose starts are closest in a straight line.
+        distances = segment_starts.nearest(origin, 10, Unit.MILES)
+
+        # Get the actual distances for the then closest.
+        top_ten_destinations = [segment_latlngs[i][0] for (i, _) in distances[:10]]
+        distance_destinations = matrix_builder.build([origin], top_ten_destinations)[0]
+        indices_sorted = sorted(range(len(distance_destinations)),
+                                 key=lambda k: distance_destinations[k])
+
+        closest_index = distances[indices_sorted[0]][0]
+        closest_next_segment = segment_latlngs[closest_index]
+
+        # Take the closest as the next value, and its end point as the next start.
+        result = result + [closest_next_segment]
+        origin = closest_next_segment[len(closest_next_segment) - 1]
+        remaining.remove(closest_index)
+        segment_starts.remove(closest_index)
+        indices.append(closest_index)
+
+        if max_segments != -1 and len(segment_latlngs) - len(remaining) >= max_segments:
+            break
+
+    return result
+
+def simplify_leg(leg, tolerance_meters):
+    if tolerance_meters <= 0 or len(leg) <= 2:
+        return leg
+    with metrics.timer("simplify"):
+        return [leg[i] for i in Route.from_latlngs(leg).simplified_indices(tolerance_meters)]
+
+def fetch_route_directions(directions_fetcher, start_latlng, next_latlng, segment_latlngs):
+    # The encoded directions for every leg between points of the route, in order:
+    # to the next point, to the start of each segment, then home. Every leg's
+    # endpoints are known up front, so they are all fetched together.
+    connections = []
+    last_latlng = start_latlng
+    if (next_latlng is not None):
+        connections.append((start_latlng, next_latlng))
+        last_latlng = next_latlng
+    for segment_latlng in segment_latlngs:
+        # Go from previous point to start of segment
+        connections.append((last_latlng, segment_latlng[0]))
+        last_latlng = segment_latlng[len(segment_latlng) - 1]
+
+    # Go from last segment back to first.
+    connections.append((last_latlng, start_latlng))
+    return directions_fetcher.fetch_polylines(connections)
+
+def route_legs(directions, start_latlng, next_latlng, segment_latlngs,
+               transit_tolerance_meters=0, segment_tolerance_meters=0, report=False):
+    # Yields the route one leg at a time, in order: the start point, directions
+    # to the next point, then directions to and along each segment, then
+    # directions home. directions is what fetch_route_directions returns, and
+    # each one is only decoded when its leg is reached, so just one leg of
+    # directions is decoded at a time. Directions and segments are simplified
+    # with their own tolerances, since segments have to stay close enough to the
+    # original for Strava to match them. With report the points simplification
+    # removed are printed once the last leg has been yielded.
+    counts = {"full": 1, "kept": 1}
+
+    def leg(latlngs, tolerance_meters):
+        simplified = simplify_leg(latlngs, tolerance_meters)
+        counts["full"] = counts["full"] + len(latlngs)
+        counts["kept"] = counts["kept"] + len(simplified)
+        return simplified
+
+    directions = iter(directions)
+    yield [start_latlng]
+    if (next_latlng is not None):
+        yield leg(googlemaps.convert.decode_polyline(next(directions)), transit_tolerance_meters)
+    for segment_latlng in segment_latlngs:
+        yield leg(googlemaps.convert.decode_polyline(next(directions)), transit_tolerance_meters)
+
+        # Go from start of segment to end
+        yield leg(segment_latlng, segment_tolerance_meters)
+    yield leg(googlemaps.convert.decode_polyline(next(directions)), transit_tolerance_meters)
+
+    if report and (transit_tolerance_meters > 0 or segment_tolerance_meters > 0):
+        removed = counts["full"] - counts["kept"]
+        print("Simplified route from {} to {} points, removed {}".format(counts["full"], counts["kept"], removed))
+        metrics.count("simplify_points_removed", removed)
+
+def legs_distance_in_miles(legs):
+    # Length of the route made by joining the legs end to end.
+    distance = 0
+    prev_latlon = None
+    for leg in legs:
+        if len(leg) == 0: continue
+        distance = distance + compute_distance_in_miles(leg if prev_latlon is None else [prev_latlon] + leg)
+        prev_latlon = leg[len(leg) - 1]
+    return distance
+
+def make_gpx(directions_fetcher, start_latlng, next_latlng, segment_latlngs, output_file_name,
+             transit_tolerance_meters=0, segment_tolerance_meters=0):
+    # The start time in the GPX header depends on the length of the whole route,
+    # so the legs are walked twice, once to measure the route and once to write
+    # it. Both walks decode one leg at a time, so beyond the segments the caller
+    # already holds, memory doesn't grow with the length of the route.
+    with metrics.timer("directions"):
+        directions = fetch_route_directions(directions_fetcher, start_latlng, next_latlng, segment_latlngs)
+    with metrics.timer("write_gpx"):
+        overall_distance = legs_distance_in_miles(route_legs(
+            directions, start_latlng, next_latlng, segment_latlngs,
+            transit_tolerance_meters, segment_tolerance_meters, report=True))
+        legs = route_legs(directions, start_latlng, next_latlng, segment_latlngs,
+                          transit_tolerance_meters, segment_tolerance_meters)
+        write_gpx(itertools.chain.from_iterable(legs), output_file_name, overall_distance)
+
+def maps_client(args):
+    if args.osm_file is not None:
+        with metrics.timer("load_osm"):
+            return OsmRouter(OsmGraph.load(args.osm_file))
+    return googlemaps.Client(key=args.maps_api_key)
+
+def maps_cache(args):
+    # Routing locally is cheap enough that there is nothing to gain from caching.
+    if not args.cache_file or args.osm_file is not None:
+        return None
+    return MapsCache(args.cache_file, precision=args.cache_precision,
+                     ttl_seconds=args.cache_ttl_days * 24 * 3600,
+                     max_entries=args.cache_max_entries)
+
+def segment_loader(args, store):
+    return SegmentLoader(store, args.strava_access_token,
+                         negative_ttl_seconds=args.segment_failure_ttl_minutes * 60)
+
+def build_route(args, gmaps, cache, loader):
+    # Writes the route for args to args.output_file and returns the ids of the
+    # segments on it in the order they are ridden. The clients, cache and loader
+    # are passed in so the route server can keep them between routes.
+    segments = args.segments.split(',')
+    (start_lat, start_lng) = args.start_lat_lng.split(',')
+    start_latlng = start_latlng = {"lat": start_lat, "lng": start_lng}
+
+    if args.next_point is not None:
+        (next_lat, next_lng) = args.next_point.split(',')
+        next_latlng = {"lat": next_lat, "lng": next_lng}
+    else: next_latlng = None
+
+    matrix_builder = DistanceMatrixBuilder(gmaps, cache, max_workers=args.maps_workers)
+
+    indices = []
+    with metrics.timer("load_segments"):
+        (segments, segment_information) = get_segments_information(loader, segments)
+
+    with metrics.timer("ordering"):
+        if args.heldkarp:
+            segment_latlngs_ordered = get_segment_ordering_heldkarp(
+                matrix_builder, next_latlng if next_latlng is not None else start_latlng, segment_information,
+                args.max_segments, indices)
+        elif args.branch_and_bound:
+            segment_latlngs_ordered = get_segment_ordering_branch_and_bound(
+                matrix_builder, next_latlng if next_latlng is not None else start_latlng, segment_information,
+                args.branch_and_bound_max_nodes, args.branch_and_bound_seconds, indices)
+        elif args.cluster:
+            segment_latlngs_ordered = get_segment_ordering_clustered(
+                matrix_builder, next_latlng if next_latlng is not None else start_latlng, segment_information,
+                args.max_cluster_size, args.cluster_workers, indices)
+        elif args.optimizer:
+            segment_latlngs_ordered = get_segment_ordering_optimizer(
+                matrix_builder, next_latlng if next_latlng is not None else start_latlng, segment_information,
+                args.optimizer_seconds, indices)
+        else:
+            segment_latlngs_ordered = get_segment_ordering_greedy(
+                matrix_builder, next_latlng if next_latlng is not None else start_latlng,
+                [x["latlngs"] for x in segment_information], args.max_segments, indices)
+
+    directions_fetcher = DirectionsFetcher(gmaps, cache, max_workers=args.maps_workers)
+    make_gpx(directions_fetcher, start_latlng, next_latlng, segment_latlngs_ordered, args.output_file,
+             args.simplify_transit_meters, args.simplify_segment_meters)
+    return [segments[i] for i in indices]
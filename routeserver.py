@@ -0,0 +1,416 @@
+#!/usr/bin/env python3.8
+
+# A long running local service for the route builder and leaderboard tools.
+# Each run of a tool starts cold: it opens its SQLite caches, decodes segment
+# geometry, parses the OSM extract and crawls leaderboards from scratch. The
+# server keeps all of that in memory between jobs instead. Decoded segments,
+# distances, directions and leaderboard pages are held in LRU caches in front
+# of the usual SQLite files, and Google Maps clients, OSM graphs and leaderboard
+# crawlers are kept open.
+#
+# Jobs are submitted over HTTP on localhost as JSON, usually by running a tool
+# with --server, and queue up for a fixed number of workers. The event loop
+# only handles requests, each job runs on a worker thread.
+#
+#   POST /jobs        {"kind": "route" or "leaderboard", "arguments": {...}, "wait": false}
+#   GET  /jobs/{id}   the job's status, and its result once it is done
+#   GET  /status      queue length, cache sizes and metrics
+#
+# Every job records into the one process wide metrics registry, so the metrics
+# in /status are totals for all the jobs since the server started, not for any
+# one job. Jobs run at once and share caches, so there is no clean way to split
+# them up.
+#
+# The arguments are the tool's command line arguments by name, as jobclient
+# sends them. With --fake the server uses the offline fakes instead of Google
+# Maps and Strava, which is how it can be tried out locally.
+
+import argparse
+import asyncio
+import itertools
+import json
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import fakes
+import jobclient
+import leaderboard
+import metrics
+import routeplanner
+from segmentstore import SegmentStore
+from snapshotstore import SnapshotStore
+
+class LruCache():
+    # A map that keeps at most max_entries, dropping the least recently used.
+    # Safe to use from several threads. Hits and misses are counted in the
+    # metrics if it has a name.
+    def __init__(self, name, max_entries):
+        self.name = name
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self._count("misses")
+                return default
+            self.entries.move_to_end(key)
+            self._count("hits")
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self._count("evictions")
+
+    def _count(self, event):
+        if self.name is not None:
+            metrics.count("{}_{}".format(self.name, event))
+
+    def __len__(self):
+        return len(self.entries)
+
+class MemorySegmentStore():
+    # A SegmentStore with recently used segments kept decoded in memory.
+    def __init__(self, store, max_entries):
+        self.store = store
+        self.segments = LruCache("memory_segments", max_entries)
+        self.lock = threading.Lock()
+
+    def get_many(self, segment_ids):
+        result = {}
+        missing = []
+        for segment_id in [str(x) for x in segment_ids]:
+            segment = self.segments.get(segment_id)
+            if segment is None:
+                missing.append(segment_id)
+            else:
+                result[segment_id] = segment
+        if len(missing) > 0:
+            with self.lock:
+                stored = self.store.get_many(missing)
+            for (segment_id, segment) in stored.items():
+                self.segments.put(segment_id, segment)
+            result.update(stored)
+        return result
+
+    def put_many(self, segments):
+        with self.lock:
+            self.store.put_many(segments)
+        for segment in segments:
+            self.segments.put(segment.segment_id, segment)
+
+    def get_failures(self, segment_ids):
+        with self.lock:
+            return self.store.get_failures(segment_ids)
+
+    def put_failures(self, failures, ttl_seconds):
+        with self.lock:
+            self.store.put_failures(failures, ttl_seconds)
+
+    def import_json_directory(self, directory, segment_ids=None):
+        with self.lock:
+            return self.store.import_json_directory(directory, segment_ids)
+
+class MemoryMapsCache():
+    # The MapsCache interface with recent distances and directions kept in
+    # memory, in front of a MapsCache if there is one.
+    def __init__(self, cache, precision, ttl_seconds, max_entries):
+        self.cache = cache
+        self.precision = precision
+        self.ttl_seconds = ttl_seconds
+        self.entries = LruCache("memory_maps", max_entries)
+
+    def key(self, latlng):
+        return "{:.{p}f},{:.{p}f}".format(float(latlng["lat"]), float(latlng["lng"]), p=self.precision)
+
+    def _get(self, table, pairs, mode):
+        oldest = time.time() - self.ttl_seconds
+        found = {}
+        missing = []
+        for pair in pairs:
+            entry = self.entries.get((table, pair, mode))
+            if entry is not None and entry[1] >= oldest:
+                found[pair] = entry[0]
+            else:
+                missing.append(pair)
+        if len(missing) > 0 and self.cache is not None:
+            stored = getattr(self.cache, "get_" + table)(missing, mode)
+            now = time.time()
+            for (pair, value) in stored.items():
+                self.entries.put((table, pair, mode), (value, now))
+            found.update(stored)
+        return found
+
+    def _put(self, table, values, mode):
+        now = time.time()
+        for (pair, value) in values.items():
+            self.entries.put((table, pair, mode), (value, now))
+        if self.cache is not None:
+            getattr(self.cache, "put_" + table)(values, mode)
+
+    def get_distances(self, pairs, mode):
+        return self._get("distances", pairs, mode)
+
+    def put_distances(self, distances, mode):
+        self._put("distances", distances, mode)
+
+    def get_directions(self, pairs, mode):
+        return self._get("directions", pairs, mode)
+
+    def put_directions(self, polylines, mode):
+        self._put("directions", polylines, mode)
+
+class MemorySnapshotStore():
+    # The SnapshotStore interface with recently crawled leaderboards kept in
+    # memory, in front of a SnapshotStore if there is one. Even without one,
+    # leaderboards crawled by an earlier job are reused while they are younger
+    # than the job's max_snapshot_age_minutes.
+    def __init__(self, store, max_entries):
+        self.store = store
+        self.leaderboards = LruCache("memory_leaderboards", max_entries)
+        self.lock = threading.Lock()
+
+    def _get(self, segment, option):
+        # Returns (fetched, pages), or None if the leaderboard was never crawled.
+        entry = self.leaderboards.get((segment, option))
+        if entry is None and self.store is not None:
+            with self.lock:
+                fetched = self.store.fetched_at(segment, option)
+                if fetched is not None:
+                    entry = (fetched, self.store.get_pages(segment, option))
+            if entry is not None:
+                self.leaderboards.put((segment, option), entry)
+        return entry
+
+    def fetched_at(self, segment, option):
+        entry = self._get(segment, option)
+        return None if entry is None else entry[0]
+
+    def get_pages(self, segment, option):
+        entry = self._get(segment, option)
+        return [] if entry is None else entry[1]
+
+    def put_pages(self, segment, option, pages):
+        self.leaderboards.put((segment, option), (time.time(), pages))
+        if self.store is not None:
+            with self.lock:
+                self.store.put_pages(segment, option, pages)
+
+class Job():
+    def __init__(self, job_id, kind, arguments):
+        self.id = job_id
+        self.kind = kind
+        self.arguments = arguments
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+        self.done = asyncio.Event()
+
+    def to_dict(self):
+        return {"id": self.id, "kind": self.kind, "status": self.status, "result": self.result,
+                "error": self.error, "submitted": self.submitted, "finished": self.finished}
+
+class RouteServer():
+    def __init__(self, workers=2, max_segments=10000, max_maps_entries=200000, max_leaderboards=1000,
+                 max_jobs=1000, fake=False):
+        self.workers = workers
+        self.max_segments = max_segments
+        self.max_maps_entries = max_maps_entries
+        self.max_leaderboards = max_leaderboards
+        self.fake = fake
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.handlers = {"route": self.run_route, "leaderboard": self.run_leaderboard}
+
+        # Clients, caches and crawlers, keyed by the arguments they were made from.
+        self.resources = LruCache(None, 32)
+        self.resource_lock = threading.Lock()
+
+        self.jobs = LruCache(None, max_jobs)
+        self.job_ids = itertools.count(1)
+        self.queue = None
+        self.running = 0
+        # Set once serve is listening, with port the one it got if it was given 0.
+        self.listening = threading.Event()
+        self.port = None
+
+    def _resource(self, key, create):
+        with self.resource_lock:
+            resource = self.resources.get(key)
+            if resource is None:
+                resource = create()
+                self.resources.put(key, resource)
+            return resource
+
+    def _maps_client(self, args):
+        if self.fake:
+            return fakes.FakeMapsClient()
+        return routeplanner.maps_client(args)
+
+    def _segment_loader(self, args, store):
+        loader = routeplanner.segment_loader(args, store)
+        if self.fake:
+            loader.client = fakes.FakeStravaClient()
+        return loader
+
+    def run_route(self, arguments):
+        args = argparse.Namespace(**arguments)
+        gmaps = self._resource(("maps", args.maps_api_key, args.osm_file), lambda: self._maps_client(args))
+        cache = None
+        if args.osm_file is None:
+            cache = self._resource(
+                ("maps_cache", args.cache_file, args.cache_precision, args.cache_ttl_days, args.cache_max_entries),
+                lambda: MemoryMapsCache(routeplanner.maps_cache(args), args.cache_precision,
+                                        args.cache_ttl_days * 24 * 3600, self.max_maps_entries))
+        store = self._resource(("segment_store", args.segment_store),
+                               lambda: MemorySegmentStore(SegmentStore(args.segment_store), self.max_segments))
+        loader = self._resource(
+            ("segment_loader", args.segment_store, args.strava_access_token, args.segment_failure_ttl_minutes),
+            lambda: self._segment_loader(args, store))
+        return {"segments": routeplanner.build_route(args, gmaps, cache, loader)}
+
+    def _crawler(self, args):
+        fetcher = fakes.FakeLeaderboardFetcher(fakes.GeneratedLeaderboards()) if self.fake else None
+        return leaderboard.SegmentCrawler(args.cookie_file, fetcher=fetcher, max_workers=args.concurrency)
+
+    def run_leaderboard(self, arguments):
+        args = argparse.Namespace(**arguments)
+        config = leaderboard.load_config(args.config_file, args.cookie_file)
+        crawler = self._resource(("crawler", args.cookie_file, args.concurrency), lambda: self._crawler(args))
+        store = self._resource(
+            ("snapshot_store", args.snapshot_file),
+            lambda: MemorySnapshotStore(SnapshotStore(args.snapshot_file) if args.snapshot_file is not None else None,
+                                        self.max_leaderboards))
+        snapshot = leaderboard.LeaderboardSnapshot(crawler, config, store, args.max_snapshot_age_minutes * 60)
+        return {"output_files": leaderboard.write_standings(config, snapshot, args.output_dir)}
+
+    def submit(self, kind, arguments):
+        if kind not in self.handlers:
+            raise ValueError("Unknown job kind {}, expected one of {}".format(kind, ", ".join(self.handlers)))
+        job = Job(next(self.job_ids), kind, arguments)
+        self.jobs.put(job.id, job)
+        self.queue.put_nowait(job)
+        metrics.count("jobs_submitted")
+        return job
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            (job.status, self.running) = ("running", self.running + 1)
+            try:
+                with metrics.timer("job_" + job.kind):
+                    job.result = await loop.run_in_executor(self.executor, self.handlers[job.kind], job.arguments)
+                job.status = "done"
+            except Exception as e:
+                traceback.print_exc()
+                (job.status, job.error) = ("failed", "{}".format(e))
+                metrics.count("jobs_failed")
+            finally:
+                (job.finished, self.running) = (time.time(), self.running - 1)
+                job.done.set()
+
+    def status(self):
+        return {"queued": self.queue.qsize(), "running": self.running, "workers": self.workers,
+                "jobs": len(self.jobs), "resources": len(self.resources), "metrics": metrics.metrics.to_dict()}
+
+    async def respond(self, method, path, body):
+        # Returns (HTTP status, JSON body).
+        if method == "GET" and path == "/status":
+            return (200, self.status())
+        if method == "POST" and path == "/jobs":
+            request = json.loads(body.decode("utf-8"))
+            job = self.submit(request["kind"], request.get("arguments", {}))
+            if not request.get("wait", False):
+                return (202, job.to_dict())
+            await job.done.wait()
+            return (200, job.to_dict())
+        if method == "GET" and path.startswith("/jobs/"):
+            job_id = path[len("/jobs/"):]
+            job = self.jobs.get(int(job_id)) if job_id.isdigit() else None
+            if job is None:
+                return (404, {"error": "No job {}".format(job_id)})
+            return (200, job.to_dict())
+        return (404, {"error": "No such endpoint {} {}".format(method, path)})
+
+    async def handle(self, reader, writer):
+        # Just enough HTTP/1.1 for jobclient: one request per connection.
+        try:
+            (method, path, _) = (await reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""): break
+                (name, value) = line.decode("latin-1").split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            (status, response) = await self.respond(method, path.split("?", 1)[0], body)
+        except (ValueError, KeyError, asyncio.IncompleteReadError) as e:
+            (status, response) = (400, {"error": "Bad request: {}".format(e)})
+
+        data = json.dumps(response).encode("utf-8")
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+            status, HTTPStatus(status).phrase, len(data)).encode("latin-1") + data)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def serve(self, host, port):
+        self.queue = asyncio.Queue()
+        workers = [asyncio.ensure_future(self.worker()) for i in range(self.workers)]
+        server = await asyncio.start_server(self.handle, host, port)
+        self.port = server.sockets[0].getsockname()[1]
+        print("Listening on http://{}:{}".format(host, self.port), flush=True)
+        self.listening.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.executor.shutdown(wait=False)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs route builder and leaderboard jobs with caches kept warm between them"
+    )
+
+    parser.add_argument("--host", type=str, required=False, default="127.0.0.1",
+                        help="The address to listen on. Jobs read and write local files, so keep this local")
+    parser.add_argument("--port", type=int, required=False,
+                        default=int(jobclient.DEFAULT_SERVER.rsplit(":", 1)[1]),
+                        help="The port to listen on")
+    parser.add_argument("--workers", type=int, required=False, default=2,
+                        help="The number of jobs to run at once, the rest wait in a queue")
+    parser.add_argument("--max_segments", type=int, required=False, default=10000,
+                        help="The most decoded segments kept in memory")
+    parser.add_argument("--max_maps_entries", type=int, required=False, default=200000,
+                        help="The most distances and directions kept in memory")
+    parser.add_argument("--max_leaderboards", type=int, required=False, default=1000,
+                        help="The most crawled leaderboards kept in memory")
+    parser.add_argument("--fake", dest="fake", action="store_true", required=False, default=False,
+                        help=("""Use made up segments, distances and leaderboards instead of
+                                 calling Strava and Google Maps, for trying the server out locally"""))
+    args = parser.parse_args()
+
+    server = RouteServer(args.workers, args.max_segments, args.max_maps_entries, args.max_leaderboards,
+                         fake=args.fake)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# A single indexed store of Strava segment geometry. Each segment is kept with
+# its polyline already decoded into a packed float64 (lat, lng) array plus its
+# distance and name, so route building doesn't have to parse a JSON file and
+# decode a polyline for every segment on every run.
+
+import json
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import googlemaps
+import numpy as np
+import requests
+
+import metrics
+from httpclient import HttpClient
+
+STRAVA_API_URL = "https://www.strava.com/api/v3"
+
+# SQLite limits the number of parameters in a single statement.
+MAX_IDS_PER_QUERY = 500
+
+class InvalidSegmentError(Exception):
+    pass
+
+# Why a segment couldn't be downloaded. permanent is True when the problem is
+# the segment itself, a missing segment or one without a usable map, rather
+# than the token, the rate limit, Strava or the network.
+DownloadFailure = namedtuple('DownloadFailure', 'error, permanent')
+
+class Segment():
+    def __init__(self, segment_id, name, length, points):
+        self.segment_id = segment_id
+        self.name = name
+        self.length = length
+
+        # An (n, 2) float64 array of lat, lng pairs.
+        self.points = points
+
+    @property
+    def lats(self):
+        return self.points[:, 0]
+
+    @property
+    def lngs(self):
+        return self.points[:, 1]
+
+    def latlngs(self):
+        return [{"lat": lat, "lng": lng} for (lat, lng) in self.points.tolist()]
+
+def parse_segment_json(segment_id, segment_json):
+    # Checks that a Strava segment payload has what route building needs, raising
+    # InvalidSegmentError for error bodies like an "Authorization Error".
+    if "map" not in segment_json or "polyline" not in segment_json.get("map", {}) or "distance" not in segment_json:
+        raise InvalidSegmentError("Segment {} has no map: {}".format(segment_id, segment_json.get("message", segment_json)))
+    latlngs = googlemaps.convert.decode_polyline(segment_json["map"]["polyline"])
+    if len(latlngs) == 0:
+        raise InvalidSegmentError("Segment {} has an empty polyline".format(segment_id))
+    points = np.array([(x["lat"], x["lng"]) for x in latlngs], dtype=np.float64)
+    return Segment(str(segment_id), segment_json.get("name", ""), segment_json["distance"], points)
+
+class SegmentStore():
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS segments (
+                   id TEXT PRIMARY KEY, name TEXT, distance REAL, points BLOB)""")
+
+        # Segments that recently failed to download, so we don't keep asking for
+        # them and burning the Strava API quota.
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS failures (
+                   id TEXT PRIMARY KEY, error TEXT, expires REAL)""")
+        self.connection.commit()
+
+    def put(self, segment):
+        self.put_many([segment])
+
+    def put_many(self, segments):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?)",
+            [(segment.segment_id, segment.name, segment.length, segment.points.tobytes())
+             for segment in segments])
+        self.connection.commit()
+
+    def get_many(self, segment_ids):
+        # Returns a map of id -> Segment for the ids that are in the store.
+        segment_ids = [str(x) for x in segment_ids]
+        result = {}
+        for start in range(0, len(segment_ids), MAX_IDS_PER_QUERY):
+            chunk = segment_ids[start:start + MAX_IDS_PER_QUERY]
+            query = "SELECT id, name, distance, points FROM segments WHERE id IN ({})".format(
+                ",".join("?" * len(chunk)))
+            for (segment_id, name, distance, points) in self.connection.execute(query, chunk):
+                result[segment_id] = Segment(segment_id, name, distance,
+                                             np.frombuffer(points, dtype=np.float64).reshape(-1, 2))
+        return result
+
+    def get(self, segment_id):
+        return self.get_many([segment_id]).get(str(segment_id))
+
+    def put_failures(self, failures, ttl_seconds):
+        # Records a map of id -> error message, each good for ttl_seconds.
+        expires = time.time() + ttl_seconds
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO failures VALUES (?, ?, ?)",
+            [(segment_id, error, expires) for (segment_id, error) in failures.items()])
+        self.connection.commit()
+
+    def get_failures(self, segment_ids):
+        # Returns a map of id -> error message for ids that failed recently.
+        segment_ids = [str(x) for x in segment_ids]
+        now = time.time()
+        result = {}
+        for start in range(0, len(segment_ids), MAX_IDS_PER_QUERY):
+            chunk = segment_ids[start:start + MAX_IDS_PER_QUERY]
+            query = "SELECT id, error FROM failures WHERE expires>? AND id IN ({})".format(
+                ",".join("?" * len(chunk)))
+            for (segment_id, error) in self.connection.execute(query, [now] + chunk):
+                result[segment_id] = error
+        return result
+
+    def import_json_directory(self, directory, segment_ids=None):
+        # Imports the segment_information/{id}.json files the route builder used
+        # to cache segments in. Files that hold an API error instead of a segment
+        # are skipped. Returns the ids that were imported.
+        segments = []
+        for filename in sorted(os.listdir(directory)):
+            (segment_id, extension) = os.path.splitext(filename)
+            if extension != ".json": continue
+            if segment_ids is not None and segment_id not in segment_ids: continue
+            with open(os.path.join(directory, filename), "r") as file:
+                try:
+                    segments.append(parse_segment_json(segment_id, json.loads(file.read())))
+                except (InvalidSegmentError, ValueError) as e:
+                    print("Skipping {}: {}".format(filename, e))
+        self.put_many(segments)
+        return [segment.segment_id for segment in segments]
+
+    def close(self):
+        self.connection.close()
+
+class SegmentLoader():
+    # Resolves a list of segment ids to Segments, downloading the ones that aren't
+    # in the store concurrently over one pooled connection. Payloads are checked
+    # before they are stored. Segments that don't exist or have no usable map
+    # are remembered for negative_ttl_seconds so reruns don't ask Strava for
+    # them again right away. Other failures, like an expired token or a rate
+    # limit, are reported but not remembered, so fixing them fixes the next run.
+    def __init__(self, store, access_token, client=None, base_url=STRAVA_API_URL,
+                 max_workers=8, negative_ttl_seconds=3600):
+        self.store = store
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.negative_ttl_seconds = negative_ttl_seconds
+        if client is None:
+            client = HttpClient(headers={"Authorization": "Bearer {}".format(access_token)},
+                                pool_size=max_workers)
+        self.client = client
+
+    def _download(self, segment_id):
+        # Returns a Segment, or a DownloadFailure if it couldn't be downloaded.
+        url = "{}/segments/{}".format(self.base_url, segment_id)
+        try:
+            response = self.client.request("GET", url)
+        except requests.RequestException as e:
+            return DownloadFailure("{}".format(e), False)
+        if response.status_code != 200:
+            return DownloadFailure("HTTP {}: {}".format(response.status_code, response.text[:200]),
+                                   response.status_code == 404)
+        try:
+            return parse_segment_json(segment_id, response.json())
+        except (InvalidSegmentError, ValueError) as e:
+            return DownloadFailure("{}".format(e), True)
+
+    def load(self, segment_ids, json_directory=None):
+        # Returns (segments, failures), maps of id -> Segment and id -> error.
+        segment_ids = [str(x) for x in segment_ids]
+        segments = self.store.get_many(segment_ids)
+        missing = [x for x in segment_ids if x not in segments]
+        failures = self.store.get_failures(missing)
+        missing = [x for x in dict.fromkeys(missing) if x not in failures]
+        if len(missing) > 0 and json_directory is not None and os.path.isdir(json_directory):
+            self.store.import_json_directory(json_directory, set(missing))
+            segments.update(self.store.get_many(missing))
+
+        to_download = [x for x in missing if x not in segments]
+        metrics.count("segments_from_store", len(segments))
+        metrics.count("segments_skipped_recent_failure", len(failures))
+        metrics.count("segment_downloads", len(to_download))
+        if len(to_download) > 0:
+            print("Downloading {} segments".format(len(to_download)))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self._download, to_download))
+
+        downloaded = []
+        new_failures = {}
+        permanent_failures = {}
+        for (segment_id, result) in zip(to_download, results):
+            if isinstance(result, Segment):
+                downloaded.append(result)
+                segments[segment_id] = result
+            else:
+                new_failures[segment_id] = result.error
+                if result.permanent:
+                    permanent_failures[segment_id] = result.error
+        self.store.put_many(downloaded)
+        self.store.put_failures(permanent_failures, self.negative_ttl_seconds)
+        metrics.count("segment_download_failures", len(new_failures))
+        failures.update(new_failures)
+
+        return (segments, failures)
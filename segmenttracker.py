@@ -2,30 +2,39 @@
 # is not leaderboard specific.
 
 import sys
+import athleteindex
 import leaderboard
+import metrics
 import json
 import argparse
 
-class SegmentTrackerHTMLParser(leaderboard.SegmentHTMLParser):
-    def __init__(self, person_name, segment, found_segments, config):
+class SegmentTrackerParserFactory():
+    # Parses the pages of one leaderboard, noting whether person_name is on it.
+    def __init__(self, person_name):
         self.person_name = person_name
-        self.segment = segment
-        self.found_segments = found_segments
-        super().__init__(config)
+        self.found = False
 
-    def handle_person(self, person_name, seconds):
-        if (person_name == self.person_name):
-            self.found_segments.add(self.segment)
+    def new(self):
+        return self.SegmentTrackerParser(self)
 
-class SegmentTrackerHTMLParserFactory():
-        def __init__(self, person, segment, found_segments, config):
-            self.person = person
-            self.segment = segment
-            self.found_segments = found_segments
-            self.config = config
+    class SegmentTrackerParser(leaderboard.RowExtractorParser):
+        def __init__(self, factory):
+            super().__init__([])
+            self.factory = factory
 
-        def new(self):
-            return SegmentTrackerHTMLParser(self.person, self.segment, self.found_segments, self.config)
+        def feed(self, page):
+            super().feed(page)
+            if any(name == self.factory.person_name for (name, seconds) in self.results):
+                self.factory.found = True
+
+def find_missing_segments(crawler, segments, option, person_name):
+    # Returns the segments whose leaderboard for option doesn't have person_name.
+    # Leaderboards are crawled concurrently, and each one stops at the first
+    # page person_name is on rather than going through every page.
+    factories = {segment: SegmentTrackerParserFactory(person_name) for segment in segments}
+    crawler.crawl_many([(segment, option, factory, lambda factory=factory: factory.found)
+                        for (segment, factory) in factories.items()])
+    return set(segment for (segment, factory) in factories.items() if not factory.found)
 
 def main():
     parser = argparse.ArgumentParser(
@@ -34,10 +43,23 @@ def main():
 
     parser.add_argument("--config_file", type=str, required=True)
     parser.add_argument("--cookie_file", type=str, required=True)
-    parser.add_argument("--name", type=str, required=True)
+    parser.add_argument("--name", type=str, required=False, default=None)
+    parser.add_argument("--names_file", type=str, required=False, default=None,
+                        help=("""A file with one athlete name per line to use instead of name.
+                                 The leaderboards are crawled once and the missing segments of
+                                 each athlete are written to a CSV for them in output_dir"""))
+    parser.add_argument("--output_dir", type=str, required=False, default=None,
+                        help="Where the CSV for each athlete in names_file is written")
     parser.add_argument("--filter", type=str, required=False, default="filter=overall")
+    parser.add_argument("--concurrency", type=int, required=False, default=4,
+                        help="The number of leaderboards to crawl at once")
+    metrics.add_argument(parser)
 
     args = parser.parse_args()
+    if (args.name is None) == (args.names_file is None):
+        parser.error("one of --name or --names_file is required")
+    if args.names_file is not None and args.output_dir is None:
+        parser.error("--output_dir is required with --names_file")
 
     config_file = open(args.config_file, "r")
     config_file_contents = config_file.read()
@@ -45,16 +67,26 @@ def main():
     cookie_file = args.cookie_file
     config = leaderboard.Config(json_config, cookie_file)
 
-    all_segments = set(config.segments)
-    found_segments = set()
-
-    for segment in all_segments:
-        factory = SegmentTrackerHTMLParserFactory(args.name, segment, found_segments, config)
-        crawler = leaderboard.SegmentCrawler(cookie_file)
-        crawler.crawl(segment, args.filter, factory)
-
-    missing_segments = all_segments - found_segments
-    print(",".join(missing_segments))
+    crawler = leaderboard.SegmentCrawler(cookie_file, max_workers=args.concurrency)
+    if args.name is not None:
+        with metrics.timer("find_missing_segments"):
+            missing_segments = find_missing_segments(crawler, sorted(set(config.segments)), args.filter, args.name)
+        print(",".join(missing_segments))
+    else:
+        # Every page of every leaderboard is needed here, so the crawls can't
+        # stop early like they do for one name.
+        snapshot = leaderboard.LeaderboardSnapshot(crawler, config)
+        run_config = leaderboard.Config.RunConfig({"output_file": None, "options": [args.filter]})
+        with metrics.timer("find_missing_segments"):
+            index = athleteindex.build_index(snapshot, config, run_config)
+        names = athleteindex.read_names(args.names_file)
+        for (name, output_file) in athleteindex.output_files(args.output_dir, names).items():
+            missing_segments = index.missing_segments(name)
+            with open(output_file, 'w') as file:
+                for segment in missing_segments:
+                    file.write(segment + "\n")
+            print("{},{}".format(name, len(missing_segments)))
+    metrics.report(args.metrics)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,49 @@
+# Persists crawled leaderboards between runs. Each leaderboard is stored page by
+# page as the parsed (athlete, seconds) rows plus a fingerprint of them, so a
+# refresh can tell which pages and leaderboards changed.
+
+import json
+import sqlite3
+import time
+
+class SnapshotStore():
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS leaderboards (
+                   segment TEXT, option TEXT, fetched REAL,
+                   PRIMARY KEY (segment, option))""")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS pages (
+                   segment TEXT, option TEXT, page_number INTEGER, fingerprint TEXT, rows TEXT,
+                   PRIMARY KEY (segment, option, page_number))""")
+        self.connection.commit()
+
+    def fetched_at(self, segment, option):
+        # When the leaderboard was last crawled, or None if it never was.
+        row = self.connection.execute(
+            "SELECT fetched FROM leaderboards WHERE segment=? AND option=?",
+            (segment, option)).fetchone()
+        return None if row is None else row[0]
+
+    def get_pages(self, segment, option):
+        # Returns the stored pages in order as (fingerprint, rows) pairs.
+        pages = []
+        for (fingerprint, rows) in self.connection.execute(
+                "SELECT fingerprint, rows FROM pages WHERE segment=? AND option=? ORDER BY page_number",
+                (segment, option)):
+            pages.append((fingerprint, [(name, seconds) for (name, seconds) in json.loads(rows)]))
+        return pages
+
+    def put_pages(self, segment, option, pages):
+        self.connection.execute("DELETE FROM pages WHERE segment=? AND option=?", (segment, option))
+        self.connection.executemany(
+            "INSERT INTO pages VALUES (?, ?, ?, ?, ?)",
+            [(segment, option, page_number, fingerprint, json.dumps(rows))
+             for (page_number, (fingerprint, rows)) in enumerate(pages)])
+        self.connection.execute("INSERT OR REPLACE INTO leaderboards VALUES (?, ?, ?)",
+                                (segment, option, time.time()))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,107 @@
+# A uniform lat/lng grid over a set of points that supports k nearest neighbor
+# queries and deletion. The greedy segment ordering uses it to find the closest
+# unvisited segment starts without measuring the distance to all of them on
+# every step.
+
+import math
+
+import numpy as np
+from haversine import Unit
+
+from geometry import EARTH_RADIUS_KM, UNITS_PER_KM, haversine_distances
+
+# Length of one degree of latitude.
+KM_PER_DEGREE = 2 * math.pi * EARTH_RADIUS_KM / 360
+
+class GridIndex():
+    def __init__(self, lats, lngs, cell_size_degrees=None):
+        self.lats = np.ascontiguousarray(lats, dtype=np.float64)
+        self.lngs = np.ascontiguousarray(lngs, dtype=np.float64)
+        if cell_size_degrees is None:
+            # Aim for a few points per cell.
+            extent = max(np.ptp(self.lats), np.ptp(self.lngs)) if len(self.lats) > 0 else 0
+            cell_size_degrees = max(extent / max(math.sqrt(len(self.lats) / 4), 1), 1e-3)
+        self.cell_size = cell_size_degrees
+
+        self.cells = {}
+        for i in range(len(self.lats)):
+            self.cells.setdefault(self._cell(self.lats[i], self.lngs[i]), set()).add(i)
+        self.size = len(self.lats)
+
+        if self.size > 0:
+            rows = [cell[0] for cell in self.cells]
+            columns = [cell[1] for cell in self.cells]
+            self.bounds = (min(rows), max(rows), min(columns), max(columns))
+        self.max_abs_lat = float(np.max(np.abs(self.lats))) if self.size > 0 else 0
+
+    @classmethod
+    def from_latlngs(cls, latlngs, cell_size_degrees=None):
+        return cls([float(x["lat"]) for x in latlngs], [float(x["lng"]) for x in latlngs],
+                   cell_size_degrees)
+
+    def __len__(self):
+        return self.size
+
+    def _cell(self, lat, lng):
+        return (int(math.floor(lat / self.cell_size)), int(math.floor(lng / self.cell_size)))
+
+    def remove(self, i):
+        cell = self.cells[self._cell(self.lats[i], self.lngs[i])]
+        if i in cell:
+            cell.remove(i)
+            self.size = self.size - 1
+
+    def _ring(self, row, column, r):
+        # The cells exactly r steps away from (row, column).
+        if r == 0:
+            yield (row, column)
+            return
+        for c in range(column - r, column + r + 1):
+            yield (row - r, c)
+            yield (row + r, c)
+        for rr in range(row - r + 1, row + r):
+            yield (rr, column - r)
+            yield (rr, column + r)
+
+    def _ring_lower_bound(self, latitude, r, unit):
+        # Points outside the first r rings are at least r whole cells away in
+        # latitude or longitude. Longitude degrees shrink towards the poles so use
+        # the narrowest they can be among the indexed points and the query. The
+        # great circle can be slightly shorter than the parallel, hence the slack.
+        widest_lat = min(max(abs(latitude), self.max_abs_lat) + self.cell_size * (r + 1), 90)
+        degree = KM_PER_DEGREE * UNITS_PER_KM[unit] * min(1, math.cos(math.radians(widest_lat)))
+        return 0.99 * r * self.cell_size * degree
+
+    def nearest(self, latlng, k, unit=Unit.MILES):
+        # Returns up to k (index, distance) pairs for the closest points that
+        # haven't been removed, closest first and ties broken by index.
+        if self.size == 0 or k <= 0:
+            return []
+        lat = float(latlng["lat"])
+        lng = float(latlng["lng"])
+        (row, column) = self._cell(lat, lng)
+        (min_row, max_row, min_column, max_column) = self.bounds
+        max_r = max(abs(row - min_row), abs(row - max_row), abs(column - min_column), abs(column - max_column))
+
+        candidates = []
+        best = []
+        r = 0
+        while r <= max_r:
+            for cell in self._ring(row, column, r):
+                if cell in self.cells:
+                    candidates.extend(self.cells[cell])
+
+            if len(candidates) >= min(k, self.size):
+                indices = np.array(candidates)
+                distances = haversine_distances(lat, lng, self.lats[indices], self.lngs[indices], unit)
+                best = sorted(zip(distances.tolist(), candidates))[:k]
+                # Done once nothing in an unsearched ring can beat the kth best.
+                if len(best) == self.size or best[len(best) - 1][0] <= self._ring_lower_bound(lat, r, unit):
+                    break
+            r = r + 1
+
+        if len(best) == 0 or r > max_r:
+            indices = np.array(candidates)
+            distances = haversine_distances(lat, lng, self.lats[indices], self.lngs[indices], unit)
+            best = sorted(zip(distances.tolist(), candidates))[:k]
+        return [(i, distance) for (distance, i) in best]
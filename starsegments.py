@@ -1,6 +1,127 @@
 import argparse
 import sys
-import subprocess
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import metrics
+from httpclient import HttpClient
+from segmentstore import STRAVA_API_URL
+
+# status is one of "starred", "already_starred" or "failed".
+StarResult = namedtuple('StarResult', 'segment_id, status, detail')
+
+class StarringError(Exception):
+    pass
+
+# Strava's short rate limit resets every 15 minutes, on the quarter hour.
+RATE_LIMIT_WINDOW_SECONDS = 15 * 60
+
+class SegmentStarrer():
+    # Stars segments concurrently over one pooled session. Segments that are
+    # already starred are looked up first and skipped. Strava reports usage
+    # against the 15 minute and daily limits in every response, so once the 15
+    # minute usage gets close to the limit all the workers wait for the next
+    # window instead of running into 429s, and once the daily limit is used up
+    # the remaining segments fail without being sent.
+    def __init__(self, access_token, client=None, base_url=STRAVA_API_URL, max_workers=4,
+                 headroom=0.9):
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.headroom = headroom
+        if client is None:
+            client = HttpClient(headers={"Authorization": "Bearer {}".format(access_token)},
+                                pool_size=max_workers)
+        self.client = client
+        self.lock = threading.Lock()
+        self.daily_limit_reached = False
+
+    def _throttle(self, response):
+        limits = response.headers.get("X-RateLimit-Limit")
+        usage = response.headers.get("X-RateLimit-Usage")
+        if limits is None or usage is None:
+            return
+        try:
+            (short_limit, daily_limit) = [int(x) for x in limits.split(",")]
+            (short_usage, daily_usage) = [int(x) for x in usage.split(",")]
+        except ValueError:
+            return
+
+        if daily_usage >= daily_limit:
+            with self.lock:
+                self.daily_limit_reached = True
+        elif short_usage >= short_limit * self.headroom:
+            wait = RATE_LIMIT_WINDOW_SECONDS - time.time() % RATE_LIMIT_WINDOW_SECONDS
+            print("Used {} of {} requests for this 15 minutes, waiting {:.0f} seconds".format(
+                short_usage, short_limit, wait))
+            metrics.count("rate_limit_pauses")
+            self.client.pause(wait)
+
+    def _request(self, method, url, **kwargs):
+        response = self.client.request(method, url, **kwargs)
+        self._throttle(response)
+        return response
+
+    def starred_segments(self):
+        # The ids of every segment the athlete has starred.
+        starred = set()
+        page = 1
+        while True:
+            response = self._request("GET", "{}/segments/starred".format(self.base_url),
+                                     params={"page": page, "per_page": 200})
+            if response.status_code != 200:
+                raise StarringError("Couldn't list starred segments, HTTP {}: {}".format(
+                    response.status_code, response.text[:200]))
+            try:
+                segments = response.json()
+            except ValueError:
+                raise StarringError("Couldn't list starred segments, the response isn't JSON: {}".format(
+                    response.text[:200]))
+            starred.update(str(x["id"]) for x in segments)
+            if len(segments) < 200: break
+            page = page + 1
+        return starred
+
+    def star(self, segment_id):
+        if self.daily_limit_reached:
+            return StarResult(segment_id, "failed", "Daily rate limit reached")
+        url = "{}/segments/{}/starred".format(self.base_url, segment_id)
+        try:
+            response = self._request("PUT", url, data={"starred": "true"})
+        except requests.RequestException as e:
+            return StarResult(segment_id, "failed", "{}".format(e))
+        if response.status_code != 200:
+            return StarResult(segment_id, "failed", "HTTP {}: {}".format(
+                response.status_code, response.text[:200]))
+        try:
+            return StarResult(segment_id, "starred", response.json().get("name", ""))
+        except ValueError:
+            return StarResult(segment_id, "failed", "The response isn't JSON: {}".format(response.text[:200]))
+
+    def star_all(self, segment_ids, skip_starred=True):
+        # Returns a StarResult per segment, in the order they were given.
+        segment_ids = list(dict.fromkeys(str(x) for x in segment_ids))
+        try:
+            starred = self.starred_segments() if skip_starred else set()
+        except (StarringError, requests.RequestException) as e:
+            # Without knowing what is starred nothing is sent, so every segment fails.
+            results = [StarResult(x, "failed", "{}".format(e)) for x in segment_ids]
+            metrics.count("segments_failed", len(results))
+            return results
+        to_star = [x for x in segment_ids if x not in starred]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = dict(zip(to_star, executor.map(self.star, to_star)))
+        for segment_id in segment_ids:
+            if segment_id in starred:
+                results[segment_id] = StarResult(segment_id, "already_starred", "")
+
+        for result in results.values():
+            metrics.count("segments_" + result.status)
+        return [results[x] for x in segment_ids]
 
 def main():
     parser = argparse.ArgumentParser(
@@ -9,14 +130,33 @@ def main():
 
     parser.add_argument("--segments", type=str, required=True)
     parser.add_argument("--strava_access_token", type=str, required=True)
+    parser.add_argument("--concurrency", type=int, required=False, default=4,
+                        help="The number of segments to star at once")
+    parser.add_argument("--no_skip_starred", dest="skip_starred", action="store_false",
+                        required=False, default=True,
+                        help="Star every segment, rather than first looking up which are already starred")
+    parser.add_argument("--base_url", type=str, required=False, default=STRAVA_API_URL,
+                        help="The Strava API to talk to, for pointing at a local stub server")
+    metrics.add_argument(parser)
 
     args = parser.parse_args()
     segments = args.segments.split(',')
 
-    for segment in segments:
-        completed = subprocess.run(["curl", "-d", "starred='true'", "-X", "PUT", "https://www.strava.com/api/v3/segments/{}/starred".format(segment), "-H", "Authorization: Bearer {}".format(args.strava_access_token)], capture_output=True)
-        segment_json = completed.stdout.decode("utf-8")
-        print(segment_json)
+    starrer = SegmentStarrer(args.strava_access_token, base_url=args.base_url,
+                             max_workers=args.concurrency)
+    with metrics.timer("star_segments"):
+        results = starrer.star_all(segments, args.skip_starred)
+
+    for result in results:
+        print("{},{},{}".format(result.segment_id, result.status, result.detail))
+    counts = {}
+    for result in results:
+        counts[result.status] = counts.get(result.status, 0) + 1
+    print(", ".join("{} {}".format(count, status) for (status, count) in sorted(counts.items())))
+    metrics.report(args.metrics)
+
+    if counts.get("failed", 0) > 0:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,28 @@
+# Checks branch and bound against Held-Karp on small asymmetric distance matrices.
+
+import random
+
+import branchbound
+import heldkarp
+import optimizer
+
+def test_two_segments_take_the_cheaper_direction():
+    dists = [[0, 1, 2], [1, 0, 100], [100, 1, 0]]
+    (path, cost, lower_bound) = branchbound.BranchAndBound(dists).solve([0, 1, 2])
+    assert (path, cost, lower_bound) == ([0, 2, 1], 4, 4)
+
+def test_matches_held_karp():
+    rng = random.Random(1)
+    for n in range(2, 8):
+        for trial in range(20):
+            dists = [[0 if i == j else rng.randint(1, 100) for j in range(n)] for i in range(n)]
+            optimal = optimizer.tour_cost(dists, heldkarp.held_karp(dists))
+
+            # Starting from the identity tour, so the search has to find the optimum itself.
+            (path, cost, lower_bound) = branchbound.BranchAndBound(dists).solve(list(range(n)))
+            assert sorted(path) == list(range(n)) and path[0] == 0
+            assert cost == optimizer.tour_cost(dists, path) == optimal
+            assert lower_bound == optimal
+
+            (path, cost, lower_bound) = branchbound.solve(dists)
+            assert cost == lower_bound == optimal
@@ -0,0 +1,46 @@
+# Checks DistanceMatrixBuilder's tiling against the fake Google Maps client.
+
+import pytest
+
+import fakes
+from distancematrix import DistanceMatrixBuilder, tile
+
+def latlngs(n, offset=0.0):
+    return [{"lat": 41.4 + 0.01 * i + offset, "lng": -79.9 - 0.01 * i} for i in range(n)]
+
+class NoDiagonalRoutes(fakes.FakeMapsClient):
+    # Has no route from a point to the one with the same index, like a
+    # segment's end to its own start behind a one way street.
+    def __init__(self, origins, destinations):
+        super().__init__()
+        self.blocked = set((o["lat"], d["lat"]) for (o, d) in zip(origins, destinations))
+
+    def distance_matrix(self, origins, destinations, mode=None, units=None):
+        matrix = super().distance_matrix(origins, destinations, mode, units)
+        for (origin, row) in zip(origins, matrix["rows"]):
+            for (destination, element) in zip(destinations, row["elements"]):
+                if (origin["lat"], destination["lat"]) in self.blocked:
+                    element.clear()
+                    element["status"] = "ZERO_RESULTS"
+        return matrix
+
+def test_tile_covers_the_grid():
+    assert tile(0, 0) == []
+    assert tile(5, 0) == []
+    tiles = tile(41, 41)
+    assert len(tiles) == 22
+    cells = [(i, j) for (rows, columns) in tiles for i in rows for j in columns]
+    assert sorted(cells) == [(i, j) for i in range(41) for j in range(41)]
+
+def test_skipped_diagonal_without_a_route_is_ignored():
+    (origins, destinations) = (latlngs(12), latlngs(12, 0.001))
+    builder = DistanceMatrixBuilder(NoDiagonalRoutes(origins, destinations))
+    matrix = builder.build(origins, destinations, skip_diagonal=True)
+    assert all(matrix[i][i] == 0 for i in range(12))
+    assert all(matrix[i][j] > 0 for i in range(12) for j in range(12) if i != j)
+
+def test_missing_route_that_was_asked_for_raises():
+    (origins, destinations) = (latlngs(3), latlngs(3, 0.001))
+    builder = DistanceMatrixBuilder(NoDiagonalRoutes(origins, destinations))
+    with pytest.raises(Exception, match="No bicycling route"):
+        builder.build(origins, destinations)
@@ -0,0 +1,31 @@
+# Checks held_karp_best_k against trying every loop on small asymmetric
+# distance matrices.
+
+import itertools
+import random
+
+import heldkarp
+import optimizer
+
+def brute_force_best_k(dists, k):
+    # The cost of the cheapest loop from 0 through exactly k other nodes.
+    others = range(1, len(dists))
+    return min(optimizer.tour_cost(dists, [0] + list(order))
+               for order in itertools.permutations(others, min(k, len(dists) - 1)))
+
+def random_dists(rng, n, high):
+    return [[0 if i == j else rng.randint(1, high) for j in range(n)] for i in range(n)]
+
+def test_best_k_matches_brute_force():
+    rng = random.Random(1)
+    for n in range(1, 8):
+        # A small high gives lots of ties, a large one mostly distinct costs.
+        for high in (5, 1000):
+            for _ in range(5):
+                dists = random_dists(rng, n, high)
+                for k in range(0, n + 1):
+                    path = heldkarp.held_karp_best_k(dists, k)
+                    assert path[0] == 0
+                    assert len(path) == min(k, n - 1) + 1
+                    assert len(set(path)) == len(path)
+                    assert optimizer.tour_cost(dists, path) == brute_force_best_k(dists, k)
@@ -0,0 +1,60 @@
+# Checks that standings built from a refreshed snapshot match a full recrawl,
+# using the fake leaderboard fetcher so nothing touches the network.
+
+import os
+
+import fakes
+import leaderboard
+from snapshotstore import SnapshotStore
+
+CONFIG = {
+    "segments": ["1", "2", "3"],
+    "points": [10, 5, 1],
+    "participation_points": 1,
+    "unmatched_participation_points": 1,
+    "runs": [
+        {"output_file": "overall.txt", "options": ["filter=overall"]},
+        {"output_file": "women.txt", "options": ["filter=overall&gender=F", "filter=overall"]},
+    ],
+}
+
+class ChangingMarkupFetcher(fakes.FakeLeaderboardFetcher):
+    # Adds markup that differs on every request, like a live page's tokens.
+    def fetch(self, url):
+        return '<meta name="csrf-token" content="{}">'.format(self.fetch_calls) + super().fetch(url)
+
+def standings(leaderboards, output_dir, store=None, fetcher_class=fakes.FakeLeaderboardFetcher):
+    # Writes the standings for CONFIG and returns {file name: contents}.
+    os.makedirs(output_dir)
+    config = leaderboard.Config(CONFIG, None)
+    crawler = leaderboard.SegmentCrawler(None, fetcher=fetcher_class(leaderboards))
+    snapshot = leaderboard.LeaderboardSnapshot(crawler, config, store)
+    result = {}
+    for output_file in leaderboard.write_standings(config, snapshot, str(output_dir)):
+        with open(output_file, "r") as file:
+            result[os.path.basename(output_file)] = file.read()
+    return (result, snapshot)
+
+def test_refresh_matches_full_recrawl(tmp_path):
+    leaderboards = fakes.GeneratedLeaderboards(riders=250)
+    store = SnapshotStore(str(tmp_path / "snapshots.db"))
+    (before, _) = standings(leaderboards, tmp_path / "before", store)
+
+    # Someone on the third page of a leaderboard sets the fastest time.
+    rows = list(leaderboards["2"]["filter=overall"])
+    (name, seconds) = rows.pop(230)
+    leaderboards["2"]["filter=overall"] = [(name, rows[0][1] - 1)] + rows
+
+    (refreshed, snapshot) = standings(leaderboards, tmp_path / "refreshed", store)
+    (cold, _) = standings(leaderboards, tmp_path / "cold")
+    assert refreshed == cold
+    assert refreshed != before
+    assert snapshot.changed == {("2", "filter=overall")}
+
+def test_markup_changes_alone_are_not_changes(tmp_path):
+    leaderboards = fakes.GeneratedLeaderboards(riders=250)
+    store = SnapshotStore(str(tmp_path / "snapshots.db"))
+    (before, _) = standings(leaderboards, tmp_path / "before", store, ChangingMarkupFetcher)
+    (after, snapshot) = standings(leaderboards, tmp_path / "after", store, ChangingMarkupFetcher)
+    assert after == before
+    assert snapshot.changed == set()
@@ -0,0 +1,21 @@
+# Checks the local search optimizer on small asymmetric distance matrices.
+
+import random
+
+import heldkarp
+import optimizer
+
+def test_two_segments_take_the_cheaper_direction():
+    dists = [[0, 1, 2], [1, 0, 100], [100, 1, 0]]
+    path = optimizer.optimize_tour(dists, 1)
+    assert path == [0, 2, 1]
+    assert optimizer.tour_cost(dists, path) == 4
+
+def test_small_routes_visit_every_segment_once():
+    rng = random.Random(1)
+    for n in range(1, 7):
+        dists = [[0 if i == j else rng.randint(1, 100) for j in range(n)] for i in range(n)]
+        path = optimizer.optimize_tour(dists, 0.1)
+        assert sorted(path) == list(range(n)) and path[0] == 0
+        if n <= 3:
+            assert optimizer.tour_cost(dists, path) == optimizer.tour_cost(dists, heldkarp.held_karp(dists))
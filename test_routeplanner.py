@@ -0,0 +1,38 @@
+# Checks that the GPX writer is fed the route a leg at a time.
+
+import itertools
+
+import googlemaps
+
+import fakes
+import routeplanner
+from directions import DirectionsFetcher
+
+START = {"lat": 41.44816, "lng": -79.9302}
+SEGMENTS = [[{"lat": 41.45 + 0.01 * i, "lng": -79.93}, {"lat": 41.455 + 0.01 * i, "lng": -79.935}]
+            for i in range(5)]
+
+def test_legs_are_decoded_as_they_are_reached(monkeypatch):
+    directions = routeplanner.fetch_route_directions(
+        DirectionsFetcher(fakes.FakeMapsClient()), START, None, SEGMENTS)
+    decoded = []
+    decode = googlemaps.convert.decode_polyline
+    monkeypatch.setattr(googlemaps.convert, "decode_polyline", lambda x: decoded.append(x) or decode(x))
+
+    legs = routeplanner.route_legs(directions, START, None, SEGMENTS)
+    assert next(legs) == [START]
+    assert len(decoded) == 0
+    next(legs)
+    assert len(decoded) == 1
+    assert len(list(legs)) == 2 * len(SEGMENTS)
+    assert len(decoded) == len(SEGMENTS) + 1
+
+def test_make_gpx_matches_writing_every_point_at_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(routeplanner.time, "time", lambda: 1700000000.0)
+    fetcher = DirectionsFetcher(fakes.FakeMapsClient())
+    routeplanner.make_gpx(fetcher, START, None, SEGMENTS, str(tmp_path / "streamed.gpx"))
+
+    directions = routeplanner.fetch_route_directions(fetcher, START, None, SEGMENTS)
+    points = list(itertools.chain.from_iterable(routeplanner.route_legs(directions, START, None, SEGMENTS)))
+    routeplanner.write_gpx(points, str(tmp_path / "joined.gpx"))
+    assert (tmp_path / "streamed.gpx").read_text() == (tmp_path / "joined.gpx").read_text()
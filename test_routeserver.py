@@ -0,0 +1,92 @@
+# Runs a fake route server on a free port and sends it jobs the way the tools
+# do with --server, checking the results and that later jobs hit its caches.
+
+import asyncio
+import json
+import os
+import threading
+
+import pytest
+
+import fakes
+import jobclient
+import leaderboard
+import routebuilder
+import routeserver
+
+CONFIG = {
+    "segments": ["1", "2", "3"],
+    "points": [10, 5, 1],
+    "participation_points": 1,
+    "unmatched_participation_points": 1,
+    "runs": [{"output_file": "overall.txt", "options": ["filter=overall"]}],
+}
+
+@pytest.fixture
+def server():
+    route_server = routeserver.RouteServer(fake=True)
+    thread = threading.Thread(target=lambda: asyncio.run(route_server.serve("127.0.0.1", 0)), daemon=True)
+    thread.start()
+    assert route_server.listening.wait(10)
+    return "http://127.0.0.1:{}".format(route_server.port)
+
+def counters(server):
+    # The metrics are totals for everything this process has run, tests included.
+    return jobclient.request(server, "GET", "/status")["metrics"]["counters"]
+
+def added(before, after, name):
+    return after.get(name, 0) - before.get(name, 0)
+
+def test_route_jobs_reuse_the_server_caches(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    args = routebuilder.build_parser().parse_args([
+        "--maps_api_key", "fake", "--strava_access_token", "fake", "--segments", "11,12,13,14",
+        "--start_lat_lng", "41.44816,-79.9302", "--output_file", "route.gpx"])
+    paths = ["osm_file", "output_file", "cache_file", "segment_store"]
+
+    before = counters(server)
+    first = jobclient.submit(server, "route", args, paths)
+    assert sorted(first["segments"]) == ["11", "12", "13", "14"]
+    with open(tmp_path / "route.gpx", "r") as file:
+        assert "<trkpt" in file.read()
+    middle = counters(server)
+    assert added(before, middle, "segment_downloads") == 4
+
+    second = jobclient.submit(server, "route", args, paths)
+    assert second == first
+    after = counters(server)
+    assert added(middle, after, "segment_downloads") == 0
+    assert added(middle, after, "memory_segments_hits") == 4
+    assert added(middle, after, "memory_maps_hits") > 0
+    assert added(middle, after, "memory_maps_misses") == 0
+    assert added(before, after, "jobs_submitted") == 2
+
+def test_leaderboard_jobs_match_a_local_run(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open("config.json", "w") as file:
+        json.dump(CONFIG, file)
+    os.makedirs("server")
+    args = leaderboard.build_parser().parse_args([
+        "--config_file", "config.json", "--cookie_file", "cookies.txt", "--output_dir", "server",
+        "--max_snapshot_age_minutes", "60"])
+    paths = ["config_file", "cookie_file", "output_dir", "snapshot_file"]
+
+    before = counters(server)
+    result = jobclient.submit(server, "leaderboard", args, paths)
+    assert result["output_files"] == [str(tmp_path / "server" / "overall.txt")]
+    assert added(before, counters(server), "leaderboards_crawled") == len(CONFIG["segments"])
+
+    # The same standings as crawling the same made up leaderboards here.
+    os.makedirs("local")
+    config = leaderboard.load_config("config.json", None)
+    crawler = leaderboard.SegmentCrawler(None, fetcher=fakes.FakeLeaderboardFetcher(fakes.GeneratedLeaderboards()))
+    leaderboard.write_standings(config, leaderboard.LeaderboardSnapshot(crawler, config), "local")
+    with open("server/overall.txt", "r") as served, open("local/overall.txt", "r") as local:
+        assert served.read() == local.read()
+
+    # Crawled by the first job and still young enough to be used as is.
+    middle = counters(server)
+    jobclient.submit(server, "leaderboard", args, paths)
+    after = counters(server)
+    assert added(middle, after, "leaderboards_crawled") == 0
+    assert added(middle, after, "memory_leaderboards_hits") >= len(CONFIG["segments"])
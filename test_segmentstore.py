@@ -0,0 +1,45 @@
+# Checks which download failures SegmentLoader remembers.
+
+import requests
+
+import fakes
+from segmentstore import SegmentLoader, SegmentStore
+
+class FailingStravaClient(fakes.FakeStravaClient):
+    # Serves made up segments, except for the ids in failures, which get the
+    # given status and body, or raise the given exception.
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def request(self, method, url, **kwargs):
+        segment_id = url.rstrip("/").rsplit("/", 1)[1]
+        if segment_id in self.failures:
+            self.request_calls = self.request_calls + 1
+            if isinstance(self.failures[segment_id], Exception):
+                raise self.failures[segment_id]
+            return fakes.FakeResponse(*self.failures[segment_id])
+        return super().request(method, url, **kwargs)
+
+def test_only_failures_of_the_segment_itself_are_remembered(tmp_path):
+    store = SegmentStore(str(tmp_path / "segments.db"))
+    client = FailingStravaClient({
+        "2": (404, {"message": "Record Not Found"}),
+        "3": (200, {"message": "No map here"}),
+        "4": (401, {"message": "Authorization Error"}),
+        "5": (429, {"message": "Rate Limit Exceeded"}),
+        "6": (503, "<html>Service Unavailable</html>"),
+        "7": requests.ConnectionError("Connection refused"),
+    })
+    loader = SegmentLoader(store, None, client=client)
+    (segments, failures) = loader.load(["1", "2", "3", "4", "5", "6", "7"])
+    assert set(segments) == {"1"}
+    assert set(failures) == {"2", "3", "4", "5", "6", "7"}
+    assert set(store.get_failures(["1", "2", "3", "4", "5", "6", "7"])) == {"2", "3"}
+
+    # Once the token and Strava are fine again, the next run gets the rest.
+    loader.client = fakes.FakeStravaClient()
+    (segments, failures) = loader.load(["1", "2", "3", "4", "5", "6", "7"])
+    assert set(segments) == {"1", "4", "5", "6", "7"}
+    assert set(failures) == {"2", "3"}
+    assert loader.client.request_calls == 4
@@ -0,0 +1,27 @@
+# Checks SegmentStarrer against the fake Strava starring API.
+
+import fakes
+from starsegments import SegmentStarrer
+
+def star_all(client, segment_ids):
+    starrer = SegmentStarrer(None, client=client, base_url="http://strava.test/api/v3")
+    return {result.segment_id: result for result in starrer.star_all(segment_ids)}
+
+def test_stars_segments_and_skips_starred_ones():
+    client = fakes.FakeStarClient(starred=[2])
+    results = star_all(client, [1, 2, 3, 1])
+    assert [results[x].status for x in ["1", "2", "3"]] == ["starred", "already_starred", "starred"]
+    assert results["1"].detail == "Segment 1"
+    assert client.starred == {"1", "2", "3"}
+
+def test_non_json_response_fails_only_that_segment():
+    client = fakes.FakeStarClient(html_errors=[2])
+    results = star_all(client, [1, 2, 3])
+    assert [results[x].status for x in ["1", "2", "3"]] == ["starred", "failed", "starred"]
+    assert "isn't JSON" in results["2"].detail
+
+def test_non_json_starred_list_fails_every_segment():
+    client = fakes.FakeStarClient()
+    client.request = lambda method, url, **kwargs: fakes.FakeResponse(200, "<html></html>")
+    results = star_all(client, [1, 2])
+    assert [results[x].status for x in ["1", "2"]] == ["failed", "failed"]